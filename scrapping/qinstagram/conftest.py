@@ -0,0 +1 @@
+# Makes `qinstagram` and `main` importable when running pytest from this directory
@@ -3,9 +3,14 @@ Sole purpose of this function is to extract data from instagram's API
 """
 
 import json
+import os
+import time
 
 from mypy_extensions import TypedDict
+from typing import Optional
 
+from qinstagram import fetch, profiling
+from qinstagram.crawldb import CrawlDB, location_query_id
 from qinstagram.utils import haversine_distance
 from qinstagram.transforms import standardize_instagram_posts
 from qinstagram.instagram import Instagram
@@ -21,28 +26,41 @@ from qinstagram.types import (
     RawInstagramLocationQuery
 )
 
+# Seconds kept aside (from Lambda's remaining time) to build the response
+DEADLINE_MARGIN = 1.0
+
+# Actions lambda_main_function knows how to handle
+ACTIONS = ('search_location', 'query_location', 'preview_location')
+
 
 """ Helper functions (to determine if success or not) """
 
 
-def instagram_search_location(location_name: str, geolocation: GeoLocation, count: int = 1) -> RawInstagramLocationSearch:
+def instagram_search_location(location_name: str,
+                              geolocation: GeoLocation,
+                              count: int = 1,
+                              deadline: Optional[float] = None,
+                              hedge_percentile: Optional[float] = None) -> RawInstagramLocationSearch:
     """
     Queries instagram location and returns GraphQL dump
 
     Params:
-        location_name:  Name of location
-        geolocation:    (Lat, Lng) of the location
-        count:          How many posts to scrape from location
+        location_name:    Name of location
+        geolocation:      (Lat, Lng) of the location
+        count:            How many posts to scrape from location
+        deadline:         Absolute time.time() all requests must be done by
+        hedge_percentile: Hedge requests slower than this latency percentile
     """
 
-    instagram = Instagram(INSTA_LOCATION)
+    instagram = Instagram(INSTA_LOCATION, deadline=deadline, hedge_percentile=hedge_percentile)
 
     try:
         # return json
         ret_json = {}
 
         # Get base location data
-        location_data = instagram.search_location(location_name, geolocation)
+        with profiling.stage('instagram.search_location'):
+            location_data = instagram.search_location(location_name, geolocation)
 
         # No such place
         if location_data['location'] is None:
@@ -56,10 +74,11 @@ def instagram_search_location(location_name: str, geolocation: GeoLocation, coun
         else:
             location_query_id = location_data['location']['facebook_places_id']
 
-        location_insta_data = instagram.query(
-            location_query_id,
-            count=count
-        )
+        with profiling.stage('instagram.query'):
+            location_insta_data = instagram.query(
+                location_query_id,
+                count=count
+            )
 
         ret_json['location'] = location_data['location']
         ret_json['posts'] = location_insta_data
@@ -74,25 +93,31 @@ def instagram_search_location(location_name: str, geolocation: GeoLocation, coun
     return ret_json
 
 
-def instagram_query_location(location_id: str, count: int) -> RawInstagramLocationQuery:
+def instagram_query_location(location_id: str,
+                             count: int,
+                             deadline: Optional[float] = None,
+                             hedge_percentile: Optional[float] = None) -> RawInstagramLocationQuery:
     """
     Queries instagram location and returns GraphQL dump
 
     Params:
-        location_id:  id of location
-        count:          How many posts to scrape from location
+        location_id:      id of location
+        count:            How many posts to scrape from location
+        deadline:         Absolute time.time() all requests must be done by
+        hedge_percentile: Hedge requests slower than this latency percentile
     """
 
-    instagram = Instagram(INSTA_LOCATION)
+    instagram = Instagram(INSTA_LOCATION, deadline=deadline, hedge_percentile=hedge_percentile)
 
     try:
         # return json
         ret_json = {}
 
-        location_insta_data = instagram.query(
-            location_id,
-            count=count
-        )
+        with profiling.stage('instagram.query'):
+            location_insta_data = instagram.query(
+                location_id,
+                count=count
+            )
 
         ret_json['posts'] = location_insta_data
 
@@ -104,10 +129,44 @@ def instagram_query_location(location_id: str, count: int) -> RawInstagramLocati
     return ret_json
 
 
+def get_hedge_percentile(request_json) -> Optional[float]:
+    """
+    Hedging is off unless enabled in the payload or env (INSTA_HEDGE_PERCENTILE)
+    """
+    hedge_percentile = request_json.get(
+        'hedge_percentile', os.environ.get('INSTA_HEDGE_PERCENTILE', None)
+    )
+
+    # Clamped so a payload can't make us hedge (double) every request
+    return fetch.clamp_hedge_percentile(hedge_percentile)
+
+
+def save_to_crawl_db(location_id: str, posts: InstagramPosts, location: Optional[RawInstagramLocation] = None):
+    """
+    Records crawl output in the local crawl database when CRAWL_DB is set
+    (a failure here shouldn't fail the request)
+    """
+    db_path = os.environ.get('CRAWL_DB', None)
+    if db_path is None:
+        return
+
+    try:
+        crawl_db = CrawlDB(db_path)
+        try:
+            if location is not None:
+                crawl_db.upsert_locations([location])
+            crawl_db.upsert_posts(location_id, posts)
+        finally:
+            crawl_db.close()
+
+    except Exception as e:
+        print('Unable to save to crawl db: {!r}'.format(e))
+
+
 """ Request Handlers (used to xform data to a standard format) """
 
 
-def search_location(request_json) -> TypedDict(
+def search_location(request_json, deadline: Optional[float] = None) -> TypedDict(
         'QueryLocation',
         {
             'location': RawInstagramLocation,
@@ -139,16 +198,20 @@ def search_location(request_json) -> TypedDict(
 
     # Query instagram
     ret: RawInstagramLocationSearch = instagram_search_location(
-        location_name, (latitude, longitude), count
+        location_name, (latitude, longitude), count,
+        deadline=deadline,
+        hedge_percentile=get_hedge_percentile(request_json)
     )
     
     if ret['success']:
         # ret['posts']: RawInstagramPosts
-        ret['posts']: InstagramPosts = standardize_instagram_posts(ret['posts'])
+        with profiling.stage('standardize_instagram_posts'):
+            ret['posts']: InstagramPosts = standardize_instagram_posts(ret['posts'])
+        save_to_crawl_db(location_query_id(ret['location']), ret['posts'], ret['location'])
     return ret, 200 if ret['success'] else 404
 
 
-def query_location(request_json) -> TypedDict(
+def query_location(request_json, deadline: Optional[float] = None) -> TypedDict(
         'QueryLocation',
         {
             'posts': InstagramPosts,
@@ -169,11 +232,17 @@ def query_location(request_json) -> TypedDict(
         return response, 400
 
     # Query instagram
-    ret: RawInstagramLocationQuery = instagram_query_location(location_id, count)
+    ret: RawInstagramLocationQuery = instagram_query_location(
+        location_id, count,
+        deadline=deadline,
+        hedge_percentile=get_hedge_percentile(request_json)
+    )
     
     if ret['success']:
         # ret['posts']: RawInstagramPosts
-        ret['posts']: InstagramPosts = standardize_instagram_posts(ret['posts'])
+        with profiling.stage('standardize_instagram_posts'):
+            ret['posts']: InstagramPosts = standardize_instagram_posts(ret['posts'])
+        save_to_crawl_db(location_id, ret['posts'])
     return ret, 200 if ret['success'] else 404
 
 
@@ -205,6 +274,11 @@ def lambda_main_function(event, context):
     except:
         req_action = None
 
+    # Stop talking to instagram before Lambda kills us
+    deadline = None
+    if context is not None:
+        deadline = time.time() + context.get_remaining_time_in_millis() / 1000 - DEADLINE_MARGIN
+
     # TODO: Change this so only grammable is allowed
     cors_headers = {
         'headers': {
@@ -220,22 +294,33 @@ def lambda_main_function(event, context):
             "body": json.dumps({'error': 'invalid payload'})
         }
 
+    # Only known actions get this far (and get profiled)
+    if req_action not in ACTIONS:
+        return {
+            "statusCode": 400,
+            **cors_headers,
+            "body": json.dumps({'error': 'invalid action'})
+        }
+
     # Mutation :(
     body_ret, status_code = None, None
 
-    # Search by location name
-    if req_action == 'search_location':
-        body_ret, status_code = search_location(body_json)
+    # Profile summary goes to the log (and QINSTAGRAM_PROFILE_DIR if set)
+    with profiling.profile_invocation(req_action, profiling.should_profile(body_json)):
+
+        # Search by location name
+        if req_action == 'search_location':
+            body_ret, status_code = search_location(body_json, deadline)
 
-    # Query location information
-    # (Get back photos etc)
-    if req_action == 'query_location':
-        body_ret, status_code = query_location(body_json)
+        # Query location information
+        # (Get back photos etc)
+        if req_action == 'query_location':
+            body_ret, status_code = query_location(body_json, deadline)
 
-    # Preview location
-    # Search by location name
-    if req_action == 'preview_location':
-        body_ret, status_code = query_location({**body_json, 'count': 0})
+        # Preview location
+        # Search by location name
+        if req_action == 'preview_location':
+            body_ret, status_code = query_location({**body_json, 'count': 0}, deadline)
 
     # Body ret is dict if success
     if type(body_ret) is dict:
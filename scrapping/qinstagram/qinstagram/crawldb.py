@@ -0,0 +1,348 @@
+"""
+Local SQLite store for crawl output (locations, tag counts and standardized posts)
+
+Locations are indexed with an R-tree so map rendering can load just the
+bounding box it needs instead of the whole crawl
+"""
+
+import sqlite3
+import time
+
+from typing import Iterable, List, Optional, Tuple
+
+from qinstagram.types import (
+    InstagramPost,
+    InstagramPosts,
+    RawInstagramLocation
+)
+
+# (min_lat, min_lng, max_lat, max_lng)
+BoundingBox = Tuple[float, float, float, float]
+
+_schema = """
+CREATE TABLE IF NOT EXISTS locations (
+    id          INTEGER PRIMARY KEY,
+    location_id TEXT NOT NULL UNIQUE,
+    name        TEXT,
+    short_name  TEXT,
+    address     TEXT,
+    city        TEXT,
+    lat         REAL NOT NULL,
+    lng         REAL NOT NULL,
+    updated_at  REAL NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS locations_rtree USING rtree (
+    id, min_lat, max_lat, min_lng, max_lng
+);
+CREATE TABLE IF NOT EXISTS tag_counts (
+    location_id       TEXT NOT NULL,
+    crawled_at        REAL NOT NULL,
+    total_media_count INTEGER,
+    current_tag_count INTEGER,
+    PRIMARY KEY (location_id, crawled_at)
+);
+CREATE TABLE IF NOT EXISTS posts (
+    instagram_id       TEXT PRIMARY KEY,
+    location_id        TEXT NOT NULL,
+    shortcode          TEXT,
+    display_url        TEXT,
+    thumbnail_url      TEXT,
+    caption            TEXT,
+    owner_id           TEXT,
+    taken_at_timestamp INTEGER NOT NULL,
+    is_top_post        INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS posts_taken_at ON posts (taken_at_timestamp);
+CREATE INDEX IF NOT EXISTS posts_location_taken_at ON posts (location_id, taken_at_timestamp);
+"""
+
+_post_columns = (
+    'instagram_id', 'shortcode', 'display_url', 'thumbnail_url',
+    'caption', 'owner_id', 'taken_at_timestamp'
+)
+
+
+def location_query_id(location: RawInstagramLocation) -> str:
+    """
+    Id used to query the location (falls back to facebook id
+    when the page doesn't exist on instagram, same as main.py)
+    """
+    if location['pk'] != '0':
+        return str(location['pk'])
+    return str(location['facebook_places_id'])
+
+
+class CrawlDB:
+    """
+    SQLite backed crawl database
+
+    Params:
+        db_path: Path to database file (created if it doesn't exist)
+    """
+
+    def __init__(self, db_path: str):
+        self._conn = sqlite3.connect(db_path, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.executescript(_schema)
+
+    def close(self):
+        self._conn.close()
+
+    def _transaction(self, statements):
+        """
+        Runs [(sql, rows)] with executemany inside a single transaction
+        (one fsync for the whole batch instead of one per row)
+        """
+        self._conn.execute('BEGIN')
+        try:
+            for sql, rows in statements:
+                self._conn.executemany(sql, rows)
+            self._conn.execute('COMMIT')
+        except Exception:
+            self._conn.execute('ROLLBACK')
+            raise
+
+    def upsert_locations(self, locations: Iterable[RawInstagramLocation]):
+        """
+        Bulk insert / update locations (as returned by `Instagram.search_location`)
+        """
+        now = time.time()
+        locations = list(locations)
+
+        self._transaction([
+            (
+                'INSERT INTO locations (location_id, name, short_name, address, city, lat, lng, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (location_id) DO UPDATE SET name = excluded.name, '
+                'short_name = excluded.short_name, address = excluded.address, city = excluded.city, '
+                'lat = excluded.lat, lng = excluded.lng, updated_at = excluded.updated_at',
+                [
+                    (
+                        location_query_id(location), location.get('name'), location.get('short_name'),
+                        location.get('address'), location.get('city'), location['lat'], location['lng'], now
+                    )
+                    for location in locations
+                ]
+            ),
+            # Points are stored as zero area boxes
+            (
+                'INSERT OR REPLACE INTO locations_rtree (id, min_lat, max_lat, min_lng, max_lng) '
+                'SELECT id, lat, lat, lng, lng FROM locations WHERE location_id = ?',
+                [(location_query_id(location),) for location in locations]
+            )
+        ])
+
+    def upsert_tag_counts(self, counts: Iterable[Tuple[str, Optional[int], Optional[int]]], crawled_at: Optional[float] = None):
+        """
+        Records (location_id, total_media_count, current_tag_count) snapshots
+        """
+        crawled_at = time.time() if crawled_at is None else crawled_at
+
+        self._transaction([(
+            'INSERT INTO tag_counts (location_id, crawled_at, total_media_count, current_tag_count) '
+            'VALUES (?, ?, ?, ?) ON CONFLICT (location_id, crawled_at) DO UPDATE SET '
+            'total_media_count = COALESCE(excluded.total_media_count, total_media_count), '
+            'current_tag_count = COALESCE(excluded.current_tag_count, current_tag_count)',
+            [(str(location_id), crawled_at, total, current) for location_id, total, current in counts]
+        )])
+
+    def import_raw_data(self, entries: Iterable[dict], crawled_at: Optional[float] = None):
+        """
+        Imports `raw_data.json` style entries ({latitude, longitude, current_tag_count,
+        optionally location_id / name}) as locations + tag count snapshots.
+        Entries without a location_id are keyed by their coordinates.
+        """
+        locations, counts = [], []
+        for entry in entries:
+            location_id = entry.get('location_id', None)
+            if location_id is None:
+                location_id = '{},{}'.format(entry['latitude'], entry['longitude'])
+
+            locations.append({
+                'pk': str(location_id),
+                'name': entry.get('name', None),
+                'lat': entry['latitude'],
+                'lng': entry['longitude']
+            })
+            counts.append((location_id, None, entry.get('current_tag_count', None)))
+
+        self.upsert_locations(locations)
+        self.upsert_tag_counts(counts, crawled_at)
+
+    def upsert_posts(self, location_id: str, posts: InstagramPosts, crawled_at: Optional[float] = None):
+        """
+        Stores output of `standardize_instagram_posts` for a location
+        (also records its total_media_count snapshot)
+        """
+        self.upsert_crawl_results([(location_id, posts)], crawled_at)
+
+    def upsert_crawl_results(self, results: Iterable[Tuple[str, InstagramPosts]], crawled_at: Optional[float] = None):
+        """
+        Bulk version of `upsert_posts`, takes (location_id, posts) pairs,
+        e.g. `CrawlQueue.results()` after a crawl with `instagram_crawl_handler`
+        """
+        crawled_at = time.time() if crawled_at is None else crawled_at
+
+        post_rows, count_rows, location_rows = [], [], []
+        for location_id, posts in results:
+            location_id = str(location_id)
+            location_rows.append((location_id,))
+            count_rows.append((location_id, crawled_at, posts['total_media_count']))
+            post_rows.extend(
+                (location_id, 1 if is_top else 0) + tuple(post.get(c, None) for c in _post_columns)
+                for is_top, post_list in ((False, posts['recent_posts']), (True, posts['top_posts']))
+                for post in post_list
+            )
+
+        self._transaction([
+            # Top posts are whatever the latest crawl says they are
+            (
+                'UPDATE posts SET is_top_post = 0 WHERE location_id = ? AND is_top_post = 1',
+                location_rows
+            ),
+            (
+                'INSERT INTO posts (location_id, is_top_post, {}) VALUES (?, ?, {}) '
+                'ON CONFLICT (instagram_id) DO UPDATE SET location_id = excluded.location_id, '
+                'is_top_post = MAX(is_top_post, excluded.is_top_post), caption = excluded.caption, '
+                'display_url = excluded.display_url, thumbnail_url = excluded.thumbnail_url'.format(
+                    ', '.join(_post_columns), ', '.join('?' * len(_post_columns))
+                ),
+                post_rows
+            ),
+            (
+                'INSERT INTO tag_counts (location_id, crawled_at, total_media_count) VALUES (?, ?, ?) '
+                'ON CONFLICT (location_id, crawled_at) DO UPDATE SET total_media_count = excluded.total_media_count',
+                count_rows
+            )
+        ])
+
+    def query_locations(self,
+                        bbox: Optional[BoundingBox] = None,
+                        since: Optional[float] = None,
+                        until: Optional[float] = None) -> List[dict]:
+        """
+        Locations inside bbox with their latest known tag counts
+
+        Params:
+            bbox:  (min_lat, min_lng, max_lat, max_lng), None for everything
+            since: Only consider tag counts crawled at or after this time
+            until: Only consider tag counts crawled before this time
+        """
+        where, params = [], []
+
+        if bbox is not None:
+            where.append(
+                'l.id IN (SELECT id FROM locations_rtree WHERE '
+                'min_lat >= ? AND max_lat <= ? AND min_lng >= ? AND max_lng <= ?)'
+            )
+            params.extend([bbox[0], bbox[2], bbox[1], bbox[3]])
+
+        count_where, count_params = [], []
+        if since is not None:
+            count_where.append('crawled_at >= ?')
+            count_params.append(since)
+        if until is not None:
+            count_where.append('crawled_at < ?')
+            count_params.append(until)
+
+        # Snapshots don't always carry every column (posts only know total_media_count),
+        # so each column comes from its own latest non NULL snapshot
+        count_filter = ''.join(' AND ' + w for w in count_where)
+        latest_sql = (
+            '(SELECT {0} FROM tag_counts WHERE location_id = l.location_id AND {0} IS NOT NULL{1} '
+            'ORDER BY crawled_at DESC LIMIT 1)'
+        )
+
+        sql = (
+            'SELECT * FROM (SELECT l.location_id, l.name, l.lat, l.lng, '
+            '(SELECT MAX(crawled_at) FROM tag_counts WHERE location_id = l.location_id{}) AS crawled_at, '
+            '{} AS total_media_count, {} AS current_tag_count '
+            'FROM locations l {}) WHERE crawled_at IS NOT NULL'
+        ).format(
+            count_filter,
+            latest_sql.format('total_media_count', count_filter),
+            latest_sql.format('current_tag_count', count_filter),
+            'WHERE ' + ' AND '.join(where) if len(where) > 0 else ''
+        )
+
+        return [
+            {
+                'location_id': row['location_id'],
+                'name': row['name'],
+                'latitude': row['lat'],
+                'longitude': row['lng'],
+                'crawled_at': row['crawled_at'],
+                'total_media_count': row['total_media_count'],
+                'current_tag_count': row['current_tag_count']
+            }
+            for row in self._conn.execute(sql, count_params * 3 + params)
+        ]
+
+    def query_posts(self,
+                    location_id: Optional[str] = None,
+                    bbox: Optional[BoundingBox] = None,
+                    since: Optional[int] = None,
+                    until: Optional[int] = None,
+                    limit: Optional[int] = None) -> List[InstagramPost]:
+        """
+        Posts (newest first) filtered by location / bbox and taken_at_timestamp range
+        """
+        where, params = [], []
+
+        if location_id is not None:
+            where.append('p.location_id = ?')
+            params.append(str(location_id))
+        if bbox is not None:
+            where.append(
+                'p.location_id IN (SELECT l.location_id FROM locations l JOIN locations_rtree r ON r.id = l.id '
+                'WHERE r.min_lat >= ? AND r.max_lat <= ? AND r.min_lng >= ? AND r.max_lng <= ?)'
+            )
+            params.extend([bbox[0], bbox[2], bbox[1], bbox[3]])
+        if since is not None:
+            where.append('p.taken_at_timestamp >= ?')
+            params.append(since)
+        if until is not None:
+            where.append('p.taken_at_timestamp < ?')
+            params.append(until)
+
+        sql = 'SELECT {} FROM posts p {} ORDER BY p.taken_at_timestamp DESC'.format(
+            ', '.join('p.' + c for c in _post_columns),
+            'WHERE ' + ' AND '.join(where) if len(where) > 0 else ''
+        )
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+
+        return [
+            {c: row[c] for c in _post_columns}
+            for row in self._conn.execute(sql, params)
+        ]
+
+    def get_location_posts(self, location_id: str, count: int = 32) -> Optional[InstagramPosts]:
+        """
+        `query_location`-style lookup served from the database,
+        returns None if the location hasn't been crawled
+        """
+        location_id = str(location_id)
+
+        tag_count = self._conn.execute(
+            'SELECT total_media_count FROM tag_counts WHERE location_id = ? '
+            'AND total_media_count IS NOT NULL ORDER BY crawled_at DESC LIMIT 1',
+            (location_id,)
+        ).fetchone()
+
+        if tag_count is None:
+            return None
+
+        top_rows = self._conn.execute(
+            'SELECT {} FROM posts WHERE location_id = ? AND is_top_post = 1 '
+            'ORDER BY taken_at_timestamp DESC'.format(', '.join(_post_columns)),
+            (location_id,)
+        )
+
+        return {
+            'total_media_count': tag_count['total_media_count'],
+            # Top posts can show up in recent posts too, same as instagram
+            'recent_posts': self.query_posts(location_id=location_id, limit=count),
+            'top_posts': [{c: row[c] for c in _post_columns} for row in top_rows]
+        }
@@ -0,0 +1,196 @@
+"""
+HTTP GET with per-stage timeouts, an overall deadline and optional hedging
+"""
+
+import math
+import threading
+import time
+import requests
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Dict, Optional, Tuple
+
+# (connect, read) timeouts in seconds
+Timeout = Tuple[float, float]
+
+DEFAULT_TIMEOUTS: Dict[str, Timeout] = {
+    'page': (3.05, 10),
+    'container': (3.05, 5),
+    'graphql': (3.05, 10),
+    'topsearch': (3.05, 5)
+}
+
+
+# Hedging below the median would double most traffic to instagram
+MIN_HEDGE_PERCENTILE = 50.0
+MAX_HEDGE_PERCENTILE = 99.9
+
+
+def clamp_hedge_percentile(hedge_percentile) -> Optional[float]:
+    """
+    Parses and clamps hedge percentile into a sane range (None disables hedging)
+    """
+    try:
+        hedge_percentile = float(hedge_percentile)
+    except (TypeError, ValueError):
+        return None
+
+    if math.isnan(hedge_percentile):
+        return None
+
+    return min(max(hedge_percentile, MIN_HEDGE_PERCENTILE), MAX_HEDGE_PERCENTILE)
+
+
+class DeadlineExceeded(requests.Timeout):
+    """
+    Raised when there's no time left to start (or finish) a request
+    """
+
+
+class LatencyTracker:
+    """
+    Keeps the last `max_samples` response times per stage
+    (shared between Instagram instances, so it stays warm across Lambda invocations)
+    """
+
+    def __init__(self, max_samples: int = 200):
+        self._max_samples = max_samples
+        self._samples: Dict[str, deque] = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float):
+        with self._lock:
+            if stage not in self._samples:
+                self._samples[stage] = deque(maxlen=self._max_samples)
+            self._samples[stage].append(seconds)
+
+    def percentile(self, stage: str, p: float, min_samples: int = 20) -> Optional[float]:
+        """
+        Returns None until there are enough samples to be meaningful
+        """
+        with self._lock:
+            samples = sorted(self._samples.get(stage, ()))
+
+        if len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(p / 100 * len(samples)))]
+
+
+latency_tracker = LatencyTracker()
+
+# Hedged requests outlive the call that started them (the loser keeps running),
+# so they get their own pool instead of blocking on shutdown
+_hedge_executor = ThreadPoolExecutor(max_workers=16)
+
+
+# Bodies are read in chunks this size so the deadline is checked while
+# reading, a smaller chunk notices a slow drip sooner
+READ_CHUNK_SIZE = 1024
+
+
+def _read_before(r: requests.Response, stage: str, deadline: float):
+    """
+    Reads a streamed response body, closing the connection (which frees
+    the pool thread) if it's still arriving at the deadline
+    """
+    chunks = []
+    try:
+        for chunk in r.iter_content(chunk_size=READ_CHUNK_SIZE):
+            chunks.append(chunk)
+            if time.time() >= deadline:
+                raise DeadlineExceeded('deadline exceeded reading {} response'.format(stage))
+    except Exception:
+        r.close()
+        raise
+
+    r._content = b''.join(chunks)
+
+
+def _timed_get(stage: str, url: str, timeout: Timeout, deadline: Optional[float] = None, **kwargs) -> requests.Response:
+    start = time.time()
+    try:
+        r = requests.get(url, timeout=timeout, stream=deadline is not None, **kwargs)
+        if deadline is not None:
+            _read_before(r, stage, deadline)
+
+    # Timeouts are the slowest responses of all, leaving them out biases the percentile low
+    except requests.Timeout:
+        latency_tracker.record(stage, time.time() - start)
+        raise
+
+    latency_tracker.record(stage, time.time() - start)
+    return r
+
+
+def get(stage: str,
+        url: str,
+        timeouts: Optional[Dict[str, Timeout]] = None,
+        deadline: Optional[float] = None,
+        hedge_percentile: Optional[float] = None,
+        **kwargs) -> requests.Response:
+    """
+    requests.get with timeouts for `stage`, the whole response
+    (not just each socket read) has to arrive before `deadline`
+
+    Params:
+        stage:            One of DEFAULT_TIMEOUTS' keys
+        url:              Url to GET
+        timeouts:         Overrides DEFAULT_TIMEOUTS
+        deadline:         Absolute time.time() by which the request must be done
+        hedge_percentile: If set, sends a second identical GET when the first one
+                          hasn't answered within this percentile of the stage's
+                          latency (e.g. 95, clamped to MIN / MAX_HEDGE_PERCENTILE),
+                          whichever answers first wins
+    """
+    connect_timeout, read_timeout = (timeouts or DEFAULT_TIMEOUTS).get(stage, DEFAULT_TIMEOUTS[stage])
+
+    if deadline is not None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise DeadlineExceeded('deadline exceeded before {} request'.format(stage))
+        connect_timeout = min(connect_timeout, remaining)
+        read_timeout = min(read_timeout, remaining)
+
+    timeout = (connect_timeout, read_timeout)
+
+    hedge_after = None
+    hedge_percentile = clamp_hedge_percentile(hedge_percentile)
+    if hedge_percentile is not None:
+        # None while there isn't enough history to know what "slow" is
+        hedge_after = latency_tracker.percentile(stage, hedge_percentile)
+
+    # Nothing to enforce beyond the socket timeouts
+    if hedge_after is None and deadline is None:
+        return _timed_get(stage, url, timeout, **kwargs)
+
+    # Read timeouts apply per socket read, a server dripping bytes can outlast
+    # them, so the request runs in the pool and we stop waiting at the deadline
+    # (the pool thread gives up too, at the first chunk read after it)
+    futures = [_hedge_executor.submit(_timed_get, stage, url, timeout, deadline, **kwargs)]
+
+    if hedge_after is not None:
+        if deadline is not None:
+            hedge_after = min(hedge_after, max(0, deadline - time.time()))
+        done, _ = wait(futures, timeout=hedge_after)
+
+        if len(done) == 0 and (deadline is None or time.time() < deadline):
+            futures.append(_hedge_executor.submit(_timed_get, stage, url, timeout, deadline, **kwargs))
+
+    # First successful response wins, only fail if every attempt did
+    pending = set(futures)
+    error = None
+    while len(pending) > 0:
+        remaining = None if deadline is None else max(0, deadline - time.time())
+        done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+
+        if len(done) == 0:
+            raise DeadlineExceeded('deadline exceeded during {} request'.format(stage))
+
+        for future in done:
+            try:
+                return future.result()
+            except Exception as e:
+                error = e
+
+    raise error
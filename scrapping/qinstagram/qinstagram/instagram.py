@@ -5,12 +5,12 @@ Instagram Scrapper
 import hashlib
 import re
 import json
-import requests 
 
 from mypy_extensions import TypedDict
-from typing import Union
+from typing import Dict, Optional, Union
 from urllib.parse import urlencode, quote_plus
 
+from qinstagram import fetch, profiling
 from qinstagram.utils import haversine_distance
 from qinstagram.types import (
     INSTA_LOCATION,
@@ -66,7 +66,23 @@ class Instagram:
         media='edge_owner_to_timeline_media'
     )
 
-    def __init__(self, queryType: QueryType):
+    def __init__(self,
+                 queryType: QueryType,
+                 timeouts: Optional[Dict[str, fetch.Timeout]] = None,
+                 deadline: Optional[float] = None,
+                 hedge_percentile: Optional[float] = None):
+        """
+        Params:
+            queryType:        INSTA_LOCATION or INSTA_USER
+            timeouts:         (connect, read) timeouts per stage, see fetch.DEFAULT_TIMEOUTS
+            deadline:         Absolute time.time() every request must be done by
+            hedge_percentile: Latency percentile after which a slow GET is hedged
+                              with a second identical one (None disables hedging)
+        """
+        self._timeouts = timeouts
+        self._deadline = deadline
+        self._hedge_percentile = hedge_percentile
+
         self._base_url = self._query_urls[queryType]['base_url']
         self._container_url = self._query_urls[queryType]['container_url']
 
@@ -75,6 +91,17 @@ class Instagram:
 
         self._graphql_vals = self._graphql_keys[queryType]
 
+    def _get(self, stage: str, url: str, **kwargs):
+        with profiling.stage('http.{}'.format(stage)):
+            return fetch.get(
+                stage,
+                url,
+                timeouts=self._timeouts,
+                deadline=self._deadline,
+                hedge_percentile=self._hedge_percentile,
+                **kwargs
+            )
+
     @staticmethod
     def get_insta_window_json(page_html: str):
         """
@@ -131,7 +158,7 @@ class Instagram:
         Gets query hash from initial json loaded from window (for graph ql)
         """
         containerId = re.findall(self._container_re, page_html)[0]
-        r = requests.get(self._container_url.format(containerId))
+        r = self._get('container', self._container_url.format(containerId))
         query_hash = re.findall(self._hash_re, r.text)[0]
         return query_hash
 
@@ -143,8 +170,8 @@ class Instagram:
             query_id: Instagram id (places will be an id, users will be username)
             count: How many posts to scrap
         """
-        r = requests.get(self._base_url.format(query_id),
-                         headers=self._query_base_headers)
+        r = self._get('page', self._base_url.format(query_id),
+                      headers=self._query_base_headers)
 
         # Extract HTML from page
         page_html = r.text
@@ -187,7 +214,7 @@ class Instagram:
                 query_hash,
                 quote_plus(query_variables_str)
             )
-            req = requests.get(req_url, headers=req_headers)
+            req = self._get('graphql', req_url, headers=req_headers)
 
             # Extract edge json
             cur_media_json = req.json(
@@ -229,7 +256,8 @@ class Instagram:
         # Payload to query instagram websearch api
         web_search_payload = location_name.replace(' ', '+')
 
-        r = requests.get(
+        r = self._get(
+            'topsearch',
             self._location_search_url.format(web_search_payload),
             headers=self._query_base_headers
         )
@@ -0,0 +1,264 @@
+"""
+Sampling CPU profiler + tracemalloc hooks for profiling invocations in place
+
+Enabled with QINSTAGRAM_PROFILE=1, per invocation with the payload's
+`"profile": true` (only honored when QINSTAGRAM_PROFILE_ALLOW_PAYLOAD=1, callers
+shouldn't be able to slow the function down) or sampled with
+QINSTAGRAM_PROFILE_RATE (0 - 1). Summaries are printed to the
+log, full profiles are written to QINSTAGRAM_PROFILE_DIR if it's set.
+"""
+
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import tracemalloc
+
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+# Profile of the invocation currently running (if any)
+_active_profile = None
+
+
+def should_profile(request_json: Optional[dict] = None) -> bool:
+    """
+    Whether this invocation should be profiled
+    """
+    # Strict check, the string "false" is truthy
+    if os.environ.get('QINSTAGRAM_PROFILE_ALLOW_PAYLOAD', '') == '1' and \
+            request_json is not None and request_json.get('profile') is True:
+        return True
+
+    if os.environ.get('QINSTAGRAM_PROFILE', '') == '1':
+        return True
+
+    try:
+        rate = float(os.environ.get('QINSTAGRAM_PROFILE_RATE', 0))
+    except ValueError:
+        rate = 0
+
+    return random.random() < rate
+
+
+class _StackSampler(threading.Thread):
+    """
+    Samples the target thread's stack every `interval` seconds
+    """
+
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(daemon=True)
+        self._thread_id = thread_id
+        self._interval = interval
+        self._stop_event = threading.Event()
+        # Folded stack ("outer;...;inner") -> number of samples
+        self.stacks: Counter = Counter()
+        self.samples = 0
+
+    def run(self):
+        while not self._stop_event.wait(self._interval):
+            frame = sys._current_frames().get(self._thread_id, None)
+            if frame is None:
+                continue
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{} ({}:{})'.format(
+                    code.co_name, os.path.basename(code.co_filename), code.co_firstlineno
+                ))
+                frame = frame.f_back
+
+            self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class Profile:
+    """
+    Results of a profiled invocation
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started_at = time.time()
+        self.duration = 0.0
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.interval = 0.0
+        self.peak_memory = 0
+        self.top_allocations: List[dict] = []
+        # Stage name -> [wall seconds, memory delta in bytes]
+        self.stages: Dict[str, List[float]] = {}
+
+    def top_functions(self, limit: int = 10) -> List[dict]:
+        """
+        Functions with the most samples (self = on top of the stack, total = anywhere in it)
+        """
+        self_counts: Counter = Counter()
+        total_counts: Counter = Counter()
+
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')
+            self_counts[frames[-1]] += count
+            for frame in set(frames):
+                total_counts[frame] += count
+
+        return [
+            {
+                'function': function,
+                'self_samples': count,
+                'total_samples': total_counts[function]
+            }
+            for function, count in self_counts.most_common(limit)
+        ]
+
+    def summary(self) -> dict:
+        return {
+            'name': self.name,
+            'started_at': self.started_at,
+            'duration': round(self.duration, 4),
+            'samples': self.samples,
+            'sample_interval': self.interval,
+            'peak_memory': self.peak_memory,
+            'stages': {
+                stage: {'seconds': round(seconds, 4), 'memory_delta': int(memory)}
+                for stage, (seconds, memory) in self.stages.items()
+            },
+            'top_functions': self.top_functions(),
+            'top_allocations': self.top_allocations
+        }
+
+    def save(self, output_dir: str) -> str:
+        """
+        Writes folded stacks (flamegraph.pl / speedscope input) and
+        the summary JSON, returns the path prefix used
+        """
+        os.makedirs(output_dir, exist_ok=True)
+
+        # Name can come from a payload, never let it pick the directory
+        safe_name = re.sub(r'[^\w-]', '_', str(self.name)) or 'profile'
+        prefix = os.path.join(output_dir, '{}-{}'.format(safe_name, int(self.started_at * 1000)))
+
+        with open(prefix + '.folded', 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('{} {}\n'.format(stack, count))
+
+        with open(prefix + '.json', 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+        return prefix
+
+
+@contextmanager
+def profile_invocation(name: str,
+                       enabled: bool = True,
+                       interval: float = 0.005,
+                       top_allocations: int = 10,
+                       output_dir: Optional[str] = None):
+    """
+    Profiles the body of the with statement (yields None when disabled)
+
+    Params:
+        name:            Used in the log line / file names
+        enabled:         Skip profiling entirely when False
+        interval:        Seconds between stack samples
+        top_allocations: How many allocation sites to report
+        output_dir:      Where to write profiles (defaults to QINSTAGRAM_PROFILE_DIR,
+                         only logs the summary if neither is set)
+    """
+    global _active_profile
+
+    # Don't nest, the outer profile already covers us
+    if not enabled or _active_profile is not None:
+        yield None
+        return
+
+    profile = Profile(name)
+    profile.interval = interval
+    output_dir = output_dir or os.environ.get('QINSTAGRAM_PROFILE_DIR', None)
+
+    started_tracemalloc = not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start()
+    elif hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+
+    sampler = _StackSampler(threading.get_ident(), interval)
+    _active_profile = profile
+    sampler.start()
+    start = time.time()
+
+    try:
+        yield profile
+
+    finally:
+        profile.duration = time.time() - start
+        sampler.stop()
+        _active_profile = None
+
+        # Profiling must never replace the invocation's own result / error
+        try:
+            profile.stacks = sampler.stacks
+            profile.samples = sampler.samples
+            profile.peak_memory = tracemalloc.get_traced_memory()[1]
+            profile.top_allocations = [
+                {
+                    'location': '{}:{}'.format(stat.traceback[0].filename, stat.traceback[0].lineno),
+                    'size': stat.size,
+                    'count': stat.count
+                }
+                for stat in tracemalloc.take_snapshot().filter_traces([
+                    # Leave out the profiler's own bookkeeping
+                    tracemalloc.Filter(False, __file__),
+                    tracemalloc.Filter(False, threading.__file__),
+                    tracemalloc.Filter(False, tracemalloc.__file__)
+                ]).statistics('lineno')[:top_allocations]
+            ]
+
+            summary = profile.summary()
+            if output_dir is not None:
+                summary['path'] = profile.save(output_dir)
+
+            print('PROFILE {}'.format(json.dumps(summary)))
+
+        except Exception as e:
+            print('PROFILE failed: {!r}'.format(e))
+
+        finally:
+            if started_tracemalloc:
+                tracemalloc.stop()
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Records wall time and memory delta of a stage in the active profile
+    (no-op when nothing is being profiled)
+    """
+    profile = _active_profile
+    if profile is None:
+        yield
+        return
+
+    start = time.time()
+    start_memory = tracemalloc.get_traced_memory()[0]
+
+    try:
+        yield
+
+    finally:
+        seconds = time.time() - start
+        memory = tracemalloc.get_traced_memory()[0] - start_memory
+
+        # Same stage can run more than once (e.g. per graphql page)
+        totals = profile.stages.setdefault(name, [0.0, 0])
+        totals[0] += seconds
+        totals[1] += memory
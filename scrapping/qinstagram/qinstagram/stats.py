@@ -0,0 +1,386 @@
+"""
+Streaming popularity statistics per location
+
+Fed with the output of `standardize_instagram_posts`, every structure here
+has a fixed size so memory doesn't grow with the number of posts seen
+"""
+
+import base64
+import hashlib
+import json
+import math
+import time
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from qinstagram.types import InstagramPost, InstagramPosts
+
+# Summary metrics where bigger means more popular (gaps shrink as a
+# location gets busier, latest_timestamp is a time), safe to weight a map by
+POPULARITY_METRICS = (
+    'total_media_count',
+    'posts_per_hour_24h',
+    'posts_per_day_7d',
+    'unique_posters'
+)
+
+
+class SlidingWindowCounter:
+    """
+    Ring of `num_buckets` counters, each covering `bucket_seconds`.
+    Events older than the ring are dropped.
+    """
+
+    def __init__(self, bucket_seconds: int = 3600, num_buckets: int = 24 * 7):
+        self.bucket_seconds = bucket_seconds
+        self.num_buckets = num_buckets
+        self.buckets = [0] * num_buckets
+        # Absolute bucket number of the newest bucket
+        self.head: Optional[int] = None
+
+    def add(self, timestamp: float, count: int = 1):
+        bucket = int(timestamp // self.bucket_seconds)
+
+        if self.head is None:
+            self.head = bucket
+
+        # Moved forward in time, clear buckets we're reusing
+        if bucket > self.head:
+            for b in range(self.head + 1, min(bucket, self.head + self.num_buckets) + 1):
+                self.buckets[b % self.num_buckets] = 0
+            self.head = bucket
+
+        if bucket <= self.head - self.num_buckets:
+            return
+
+        self.buckets[bucket % self.num_buckets] += count
+
+    def count(self, window_seconds: int, now: float) -> int:
+        """
+        Number of events in (now - window_seconds, now]
+        """
+        if self.head is None:
+            return 0
+
+        now_bucket = int(now // self.bucket_seconds)
+        first_bucket = now_bucket - window_seconds // self.bucket_seconds + 1
+
+        return sum(
+            self.buckets[b % self.num_buckets]
+            for b in range(max(first_bucket, self.head - self.num_buckets + 1), min(now_bucket, self.head) + 1)
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            'bucket_seconds': self.bucket_seconds,
+            'buckets': self.buckets,
+            'head': self.head
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict) -> 'SlidingWindowCounter':
+        counter = cls(d['bucket_seconds'], len(d['buckets']))
+        counter.buckets = list(d['buckets'])
+        counter.head = d['head']
+        return counter
+
+
+class HyperLogLog:
+    """
+    Approximate distinct counter (2^p one byte registers, ~1.04/sqrt(2^p) std error)
+    """
+
+    def __init__(self, p: int = 10):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(self.m)
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+    def add(self, value: str):
+        h = self._hash(value)
+        idx = h >> (64 - self.p)
+        rest = h & ((1 << (64 - self.p)) - 1)
+        # Position of leftmost 1 bit in the remaining bits
+        rank = (64 - self.p) - rest.bit_length() + 1
+
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def count(self) -> int:
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m * self.m / sum(2.0 ** -r for r in self.registers)
+
+        # Small range correction (linear counting)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.m and zeros > 0:
+            estimate = self.m * math.log(self.m / zeros)
+
+        return int(round(estimate))
+
+    def to_dict(self) -> dict:
+        return {
+            'p': self.p,
+            'registers': base64.b64encode(bytes(self.registers)).decode()
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict) -> 'HyperLogLog':
+        hll = cls(d['p'])
+        hll.registers = bytearray(base64.b64decode(d['registers']))
+        return hll
+
+
+class TDigest:
+    """
+    Merging t-digest for approximate quantiles, holds
+    at most ~`compression` centroids once compressed
+    """
+
+    def __init__(self, compression: float = 100):
+        self.compression = compression
+        # [mean, weight] sorted by mean
+        self.centroids: List[List[float]] = []
+        self.buffer: List[float] = []
+        self.min: Optional[float] = None
+        self.max: Optional[float] = None
+
+    def add(self, value: float):
+        self.buffer.append(value)
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+        if len(self.buffer) >= 5 * self.compression:
+            self._compress()
+
+    def _k(self, q: float) -> float:
+        return self.compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+    def _k_inv(self, k: float) -> float:
+        return (math.sin(k * 2 * math.pi / self.compression) + 1) / 2
+
+    def _compress(self):
+        if len(self.buffer) == 0:
+            return
+
+        items = sorted(self.centroids + [[v, 1.0] for v in self.buffer])
+        self.buffer = []
+
+        total_weight = sum(w for _, w in items)
+        merged = [list(items[0])]
+        weight_so_far = 0.0
+        q_limit = self._k_inv(self._k(0) + 1)
+
+        for mean, weight in items[1:]:
+            cur = merged[-1]
+            q = (weight_so_far + cur[1] + weight) / total_weight
+
+            if q <= q_limit:
+                cur[0] += (mean - cur[0]) * weight / (cur[1] + weight)
+                cur[1] += weight
+            else:
+                weight_so_far += cur[1]
+                q_limit = self._k_inv(self._k(weight_so_far / total_weight) + 1)
+                merged.append([mean, weight])
+
+        self.centroids = merged
+
+    def quantile(self, q: float) -> Optional[float]:
+        self._compress()
+
+        if len(self.centroids) == 0:
+            return None
+        if len(self.centroids) == 1:
+            return self.centroids[0][0]
+
+        total_weight = sum(w for _, w in self.centroids)
+        target = q * total_weight
+
+        # Interpolate between centroid midpoints (and min / max at the edges)
+        prev_mid, prev_mean = 0.0, self.min
+        cumulative = 0.0
+        for mean, weight in self.centroids:
+            mid = cumulative + weight / 2
+            if target < mid:
+                if mid == prev_mid:
+                    return mean
+                return prev_mean + (mean - prev_mean) * (target - prev_mid) / (mid - prev_mid)
+            prev_mid, prev_mean = mid, mean
+            cumulative += weight
+
+        if total_weight == prev_mid:
+            return self.max
+        return prev_mean + (self.max - prev_mean) * (target - prev_mid) / (total_weight - prev_mid)
+
+    def to_dict(self) -> dict:
+        self._compress()
+        return {
+            'compression': self.compression,
+            'centroids': self.centroids,
+            'min': self.min,
+            'max': self.max
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict) -> 'TDigest':
+        digest = cls(d['compression'])
+        digest.centroids = [list(c) for c in d['centroids']]
+        digest.min = d['min']
+        digest.max = d['max']
+        return digest
+
+
+class LocationStats:
+    """
+    Popularity statistics for a single location
+    """
+
+    def __init__(self):
+        # Hourly buckets for the last week
+        self.posts_window = SlidingWindowCounter(3600, 24 * 7)
+        self.unique_posters = HyperLogLog()
+        # Seconds between consecutive posts
+        self.post_gaps = TDigest()
+        # Newest post seen, anything older has already been counted
+        self.latest_timestamp: Optional[int] = None
+        self.total_media_count = 0
+
+    def update(self, posts: InstagramPosts):
+        """
+        Feeds output of `standardize_instagram_posts` into the stats.
+
+        Rate / gaps only use recent posts (top posts are ranked by popularity,
+        not time). Re-crawls overlap with previous crawls, so only posts newer
+        than anything seen before are counted, and the gap back to the last
+        crawl is only bridged when this crawl reached posts we've already seen
+        (otherwise there may be posts in between we never got).
+        """
+        self.total_media_count = posts['total_media_count']
+
+        seen_ids = set()
+        post: InstagramPost
+        for post in posts['recent_posts'] + posts['top_posts']:
+            if post['instagram_id'] in seen_ids:
+                continue
+            seen_ids.add(post['instagram_id'])
+
+            if post.get('owner_id', ''):
+                self.unique_posters.add(post['owner_id'])
+
+        recent_timestamps = list({
+            post['instagram_id']: post['taken_at_timestamp'] for post in posts['recent_posts']
+        }.values())
+        if len(recent_timestamps) == 0:
+            return
+
+        if self.latest_timestamp is None:
+            new_timestamps = sorted(recent_timestamps)
+            prev_timestamp = None
+        else:
+            new_timestamps = sorted(t for t in recent_timestamps if t > self.latest_timestamp)
+            overlaps = min(recent_timestamps) <= self.latest_timestamp
+            prev_timestamp = self.latest_timestamp if overlaps else None
+
+        for timestamp in new_timestamps:
+            self.posts_window.add(timestamp)
+            if prev_timestamp is not None:
+                self.post_gaps.add(timestamp - prev_timestamp)
+            prev_timestamp = timestamp
+
+        if len(new_timestamps) > 0:
+            self.latest_timestamp = new_timestamps[-1]
+
+    def summary(self, now: Optional[float] = None) -> dict:
+        """
+        Metrics the visualization can weight points by
+
+        Params:
+            now: Reference time for the windows (defaults to current time)
+        """
+        now = time.time() if now is None else now
+
+        return {
+            'total_media_count': self.total_media_count,
+            'posts_per_hour_24h': self.posts_window.count(24 * 3600, now) / 24,
+            'posts_per_day_7d': self.posts_window.count(7 * 24 * 3600, now) / 7,
+            'unique_posters': self.unique_posters.count(),
+            'post_gap_p50': self.post_gaps.quantile(0.5),
+            'post_gap_p90': self.post_gaps.quantile(0.9),
+            'post_gap_p99': self.post_gaps.quantile(0.99),
+            'latest_timestamp': self.latest_timestamp
+        }
+
+    def to_dict(self) -> dict:
+        return {
+            'posts_window': self.posts_window.to_dict(),
+            'unique_posters': self.unique_posters.to_dict(),
+            'post_gaps': self.post_gaps.to_dict(),
+            'latest_timestamp': self.latest_timestamp,
+            'total_media_count': self.total_media_count
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict) -> 'LocationStats':
+        stats = cls()
+        stats.posts_window = SlidingWindowCounter.from_dict(d['posts_window'])
+        stats.unique_posters = HyperLogLog.from_dict(d['unique_posters'])
+        stats.post_gaps = TDigest.from_dict(d['post_gaps'])
+        stats.latest_timestamp = d['latest_timestamp']
+        stats.total_media_count = d['total_media_count']
+        return stats
+
+
+class StatsEngine:
+    """
+    LocationStats keyed by location id, persisted as JSON between crawls
+    """
+
+    def __init__(self):
+        self.locations: Dict[str, LocationStats] = {}
+
+    def update(self, location_id: str, posts: InstagramPosts):
+        location_id = str(location_id)
+        if location_id not in self.locations:
+            self.locations[location_id] = LocationStats()
+        self.locations[location_id].update(posts)
+
+    def update_crawl_results(self, results: Iterable[Tuple[str, InstagramPosts]]):
+        """
+        Takes (location_id, posts) pairs, e.g. `CrawlQueue.results()` after a crawl
+        with `instagram_crawl_handler` (feeding the same results twice is harmless,
+        posts that aren't newer than what's been seen are skipped)
+        """
+        for location_id, posts in results:
+            self.update(location_id, posts)
+
+    def summaries(self, now: Optional[float] = None) -> Dict[str, dict]:
+        return {
+            location_id: stats.summary(now)
+            for location_id, stats in self.locations.items()
+        }
+
+    def save(self, path: str):
+        with open(path, 'w') as f:
+            json.dump({
+                location_id: stats.to_dict()
+                for location_id, stats in self.locations.items()
+            }, f)
+
+    def save_summaries(self, path: str, now: Optional[float] = None):
+        """
+        Writes {location_id: summary} (what `scripts/viz_simple.py` reads)
+        """
+        with open(path, 'w') as f:
+            json.dump(self.summaries(now), f)
+
+    @classmethod
+    def load(cls, path: str) -> 'StatsEngine':
+        engine = cls()
+        with open(path, 'r') as f:
+            engine.locations = {
+                location_id: LocationStats.from_dict(d)
+                for location_id, d in json.load(f).items()
+            }
+        return engine
@@ -0,0 +1,372 @@
+"""
+Downloads instagram post images and resizes them into an on-disk thumbnail cache
+"""
+
+import hashlib
+import io
+import json
+import os
+import tempfile
+import requests
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from PIL import Image
+
+from qinstagram.types import InstagramPost, InstagramPosts
+
+# Longest edge (px) of each thumbnail we generate
+THUMBNAIL_SIZES = (150, 320, 640)
+
+
+class ThumbnailCache:
+    """
+    Content-addressed image cache
+
+    Original images are stored under the sha256 of their bytes, thumbnails are
+    derived from that digest + size. An index maps instagram ids (and source
+    urls) to digests so re-running a crawl doesn't refetch anything we already
+    have, even though instagram's signed CDN urls change between crawls. Once the cache
+    grows past `max_bytes` the least recently used files are evicted.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = 512 * 1024 * 1024):
+        self._cache_dir = cache_dir
+        self._objects_dir = os.path.join(cache_dir, 'objects')
+        self._thumbs_dir = os.path.join(cache_dir, 'thumbs')
+        self._index_path = os.path.join(cache_dir, 'index.json')
+        self._max_bytes = max_bytes
+        # Bytes on disk, None until the first full scan (files written
+        # by other processes sharing cache_dir are picked up on the next scan)
+        self._total_bytes: Optional[int] = None
+
+        os.makedirs(self._objects_dir, exist_ok=True)
+        os.makedirs(self._thumbs_dir, exist_ok=True)
+
+        # instagram_id -> digest, url -> digest
+        self._ids: Dict[str, str] = {}
+        self._urls: Dict[str, str] = {}
+
+        try:
+            with open(self._index_path, 'r') as f:
+                index = json.load(f)
+            self._ids = index['ids']
+            self._urls = index['urls']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    @staticmethod
+    def _write_atomic(path: str, data: bytes):
+        """
+        Writes to a temp file and moves it into place so
+        readers never see partially written files
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        finally:
+            # Only still there if writing / replacing failed
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @staticmethod
+    def touch(path: str):
+        """
+        Marks file as recently used (mtime is used for LRU, atime is unreliable)
+        """
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    def object_path(self, digest: str) -> str:
+        return os.path.join(self._objects_dir, digest[:2], digest)
+
+    def thumbnail_path(self, digest: str, size: int) -> str:
+        return os.path.join(self._thumbs_dir, digest[:2], '{}_{}.jpg'.format(digest, size))
+
+    def lookup(self, url: str, instagram_id: Optional[str] = None) -> Optional[str]:
+        """
+        Returns digest of the image previously downloaded for instagram_id
+        (checked first, urls are re-signed every crawl) or url, if still cached
+        """
+        for index, key in ((self._ids, instagram_id), (self._urls, url)):
+            digest = index.get(key, None) if key is not None else None
+            if digest is not None and os.path.exists(self.object_path(digest)):
+                self.touch(self.object_path(digest))
+                return digest
+
+        return None
+
+    def put(self, url: str, data: bytes, instagram_ids: Iterable[str] = ()) -> str:
+        """
+        Stores image bytes and returns its digest
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.object_path(digest)
+
+        # Same image served from a different url, no need to write it again
+        if os.path.exists(path):
+            self.touch(path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._write_atomic(path, data)
+            self.track(path)
+
+        self._urls[url] = digest
+        for instagram_id in instagram_ids:
+            self._ids[instagram_id] = digest
+        return digest
+
+    def save_index(self):
+        self._write_atomic(
+            self._index_path,
+            json.dumps({'ids': self._ids, 'urls': self._urls}, separators=(',', ':')).encode()
+        )
+
+    def track(self, path: str):
+        """
+        Adds a newly written file to the cache size, so `evict`
+        doesn't have to walk the cache to know if it's over max_bytes
+        """
+        if self._total_bytes is None:
+            return
+        try:
+            self._total_bytes += os.path.getsize(path)
+        except OSError:
+            pass
+
+    def _scan(self) -> List[Tuple[float, int, str]]:
+        """
+        Returns (mtime, size, path) of every cached file
+        """
+        files: List[Tuple[float, int, str]] = []
+
+        for root_dir in (self._objects_dir, self._thumbs_dir):
+            for dirpath, _, filenames in os.walk(root_dir):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, path))
+
+        return files
+
+    def evict(self, keep: Iterable[str] = ()):
+        """
+        Removes least recently used files until cache is under max_bytes.
+        Only walks the cache when the tracked size says it's over.
+
+        Params:
+            keep: Paths that must survive (e.g. ones we're about to return)
+        """
+        if self._total_bytes is not None and self._total_bytes <= self._max_bytes:
+            return
+
+        keep = set(keep)
+        files = self._scan()
+        total_bytes = sum(size for _, size, _ in files)
+        removed = False
+
+        # Oldest first
+        files.sort()
+
+        for _, size, path in files:
+            if total_bytes <= self._max_bytes:
+                break
+            if path in keep:
+                continue
+            try:
+                os.remove(path)
+                total_bytes -= size
+                removed = True
+            except OSError:
+                pass
+
+        self._total_bytes = total_bytes
+
+        if not removed:
+            return
+
+        # Drop index entries whose originals were evicted
+        self._ids, self._urls = [
+            {
+                key: digest for key, digest in index.items()
+                if os.path.exists(self.object_path(digest))
+            }
+            for index in (self._ids, self._urls)
+        ]
+        self.save_index()
+
+
+def _download_image(url: str, timeout: float) -> bytes:
+    r = requests.get(url, timeout=timeout)
+    r.raise_for_status()
+
+    # Error / login pages can come back as 200s, don't cache them as images
+    with Image.open(io.BytesIO(r.content)) as img:
+        img.verify()
+
+    return r.content
+
+
+def _resize_image(src_path: str, dst_path: str, size: int) -> str:
+    """
+    Resizes image to fit within (size x size), keeping aspect ratio.
+    Module level so it can be pickled into the process pool.
+    """
+    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dst_path))
+    os.close(fd)
+
+    try:
+        with Image.open(src_path) as img:
+            img = img.convert('RGB')
+            img.thumbnail((size, size), Image.LANCZOS)
+            img.save(tmp_path, 'JPEG', quality=85, optimize=True)
+
+        os.replace(tmp_path, dst_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return dst_path
+
+
+def unique_post_images(posts: InstagramPosts, use_display_url: bool = False) -> List[Tuple[str, str]]:
+    """
+    Returns (instagram_id, url) pairs, deduplicated by instagram_id
+    (top posts usually show up in recent posts too). Different posts
+    sharing a url are all kept, `fetch_post_thumbnails` downloads it once.
+    """
+    seen_ids = set()
+    ret = []
+
+    post: InstagramPost
+    for post in posts['top_posts'] + posts['recent_posts']:
+        if post['instagram_id'] in seen_ids:
+            continue
+
+        seen_ids.add(post['instagram_id'])
+        ret.append((
+            post['instagram_id'],
+            post['display_url'] if use_display_url else post['thumbnail_url']
+        ))
+
+    return ret
+
+
+def fetch_post_thumbnails(posts: InstagramPosts,
+                          cache: ThumbnailCache,
+                          sizes: Iterable[int] = THUMBNAIL_SIZES,
+                          max_downloads: int = 8,
+                          max_resizers: Optional[int] = None,
+                          use_display_url: bool = False,
+                          timeout: float = 10.0) -> Dict[str, Dict[int, str]]:
+    """
+    Downloads and resizes images for standardized instagram posts
+
+    Params:
+        posts:           Output of `standardize_instagram_posts`
+        cache:           Where images / thumbnails are stored
+        sizes:           Thumbnail sizes to generate
+        max_downloads:   Max concurrent downloads
+        max_resizers:    Size of resize process pool (None = cpu count,
+                         0 = resize in this process, e.g. on Lambda)
+        use_display_url: Resize from the full sized image instead of the thumbnail
+        timeout:         Per image download timeout (seconds)
+
+    Returns:
+        {instagram_id: {size: thumbnail_path}}, posts whose
+        image couldn't be downloaded are left out
+    """
+    sizes = tuple(sizes)
+    images = unique_post_images(posts, use_display_url)
+
+    # instagram_id -> digest of original image
+    digests: Dict[str, str] = {}
+    # url -> instagram_ids waiting on it (each url is only downloaded once)
+    to_download: Dict[str, List[str]] = {}
+
+    for instagram_id, url in images:
+        digest = cache.lookup(url, instagram_id)
+        if digest is None:
+            to_download.setdefault(url, []).append(instagram_id)
+        else:
+            digests[instagram_id] = digest
+
+    # Downloading is IO bound, threads are enough
+    if len(to_download) > 0:
+        with ThreadPoolExecutor(max_workers=max_downloads) as executor:
+            futures = {
+                executor.submit(_download_image, url, timeout): url
+                for url in to_download
+            }
+            for future in as_completed(futures):
+                url = futures[future]
+                try:
+                    digest = cache.put(url, future.result(), to_download[url])
+                except Exception:
+                    continue
+                for instagram_id in to_download[url]:
+                    digests[instagram_id] = digest
+
+        cache.save_index()
+
+    # Only resize what we don't already have
+    ret: Dict[str, Dict[int, str]] = {}
+    to_resize: Dict[Tuple[str, int], Tuple[str, str]] = {}
+
+    for instagram_id, digest in digests.items():
+        ret[instagram_id] = {}
+        for size in sizes:
+            thumb_path = cache.thumbnail_path(digest, size)
+            if os.path.exists(thumb_path):
+                cache.touch(thumb_path)
+                ret[instagram_id][size] = thumb_path
+            else:
+                to_resize[(digest, size)] = (cache.object_path(digest), thumb_path)
+
+    # Resizing is CPU bound, use processes
+    resized: Dict[Tuple[str, int], str] = {}
+    if len(to_resize) > 0 and max_resizers == 0:
+        for key, (src_path, dst_path) in to_resize.items():
+            try:
+                resized[key] = _resize_image(src_path, dst_path, key[1])
+            except Exception:
+                continue
+
+    elif len(to_resize) > 0:
+        with ProcessPoolExecutor(max_workers=max_resizers) as executor:
+            futures = {
+                executor.submit(_resize_image, src_path, dst_path, key[1]): key
+                for key, (src_path, dst_path) in to_resize.items()
+            }
+            for future in as_completed(futures):
+                try:
+                    resized[futures[future]] = future.result()
+                except Exception:
+                    continue
+
+    for path in resized.values():
+        cache.track(path)
+
+    for instagram_id, digest in digests.items():
+        for size in sizes:
+            if (digest, size) in resized:
+                ret[instagram_id][size] = resized[(digest, size)]
+
+    # Couldn't make any thumbnails (e.g. corrupt original)
+    ret = {instagram_id: thumbs for instagram_id, thumbs in ret.items() if len(thumbs) > 0}
+
+    # Never evict what this call is returning
+    cache.evict(keep=[cache.object_path(digest) for digest in digests.values()] + [
+        path for thumbs in ret.values() for path in thumbs.values()
+    ])
+
+    return ret
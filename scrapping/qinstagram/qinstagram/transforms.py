@@ -26,6 +26,7 @@ def standardize_instagram_post_data(post_data: RawInstagramPostsNode) -> Instagr
     shortcode = node_data['shortcode']
     thumbnail_url = node_data['thumbnail_src']
     taken_at_timestamp = node_data['taken_at_timestamp']
+    owner_id = node_data.get('owner', {}).get('id', '')
 
     return {
         'display_url': display_url,
@@ -34,7 +35,8 @@ def standardize_instagram_post_data(post_data: RawInstagramPostsNode) -> Instagr
         'caption': caption[:180],
         'instagram_id': instagram_id,
         'shortcode': shortcode,
-        'taken_at_timestamp': taken_at_timestamp
+        'taken_at_timestamp': taken_at_timestamp,
+        'owner_id': owner_id
     }
 
 
@@ -123,7 +123,8 @@ InstagramPost = TypedDict(
         'caption': str,
         'instagram_id': str,
         'shortcode': str,
-        'taken_at_timestamp': int
+        'taken_at_timestamp': int,
+        'owner_id': str
     }
 )
 
@@ -143,4 +144,18 @@ InstagramLocationSearch = TypedDict(
         'posts': InstagramPosts,
         'success': bool
     }
-)
\ No newline at end of file
+)
+
+### Crawl Types (work queue) ###
+
+
+CrawlLease = TypedDict(
+    'CrawlLease',
+    {
+        'query_type': QueryType,
+        'key': str,
+        'worker_id': str,
+        'attempts': int,
+        'expires_at': float
+    }
+)
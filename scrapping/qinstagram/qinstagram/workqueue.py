@@ -0,0 +1,335 @@
+"""
+SQLite backed work queue so a crawl can be spread across worker processes
+
+Workers must run on the same host as the database file (on local disk).
+SQLite relies on file locks, which are unreliable on network filesystems
+(NFS / SMB), so two machines sharing the file over one can lease the same
+key twice or corrupt the database.
+"""
+
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from typing import Callable, Iterable, List, Optional
+
+from qinstagram.instagram import Instagram
+from qinstagram.transforms import standardize_instagram_posts
+from qinstagram.types import (
+    INSTA_LOCATION,
+    QueryType,
+    CrawlLease,
+    InstagramPosts
+)
+
+STATUS_PENDING = 'pending'
+STATUS_LEASED = 'leased'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+_schema = """
+CREATE TABLE IF NOT EXISTS crawl_tasks (
+    query_type   TEXT NOT NULL,
+    key          TEXT NOT NULL,
+    status       TEXT NOT NULL,
+    attempts     INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    worker_id    TEXT,
+    expires_at   REAL,
+    result       TEXT,
+    error        TEXT,
+    updated_at   REAL NOT NULL,
+    PRIMARY KEY (query_type, key)
+);
+CREATE INDEX IF NOT EXISTS crawl_tasks_status ON crawl_tasks (status, expires_at);
+CREATE INDEX IF NOT EXISTS crawl_tasks_lease ON crawl_tasks (status, attempts, updated_at);
+"""
+
+
+class CrawlQueue:
+    """
+    Queue of location ids / usernames to crawl
+
+    Workers lease keys for `lease_seconds`, if a worker crashes its lease
+    expires and the key is handed to another worker. Each key is attempted
+    at most `max_attempts` times before it is marked as failed.
+    """
+
+    def __init__(self, db_path: str, max_attempts: int = 3, lease_seconds: float = 300):
+        self._db_path = db_path
+        self._max_attempts = max_attempts
+        self._lease_seconds = lease_seconds
+
+        conn = self._connect()
+        try:
+            conn.executescript(_schema)
+        finally:
+            conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        New connection per call so the queue can be shared between threads
+        (autocommit, transactions are started explicitly)
+        """
+        conn = sqlite3.connect(self._db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def add(self, keys: Iterable[str], query_type: QueryType = INSTA_LOCATION, max_attempts: Optional[int] = None) -> int:
+        """
+        Adds keys to the queue, keys that are already queued are left alone
+
+        Returns:
+            Number of keys added
+        """
+        max_attempts = max_attempts or self._max_attempts
+        now = time.time()
+
+        conn = self._connect()
+        try:
+            cur = conn.executemany(
+                'INSERT OR IGNORE INTO crawl_tasks '
+                '(query_type, key, status, max_attempts, updated_at) VALUES (?, ?, ?, ?, ?)',
+                [(query_type, str(key), STATUS_PENDING, max_attempts, now) for key in keys]
+            )
+            return cur.rowcount
+        finally:
+            conn.close()
+
+    def lease(self, worker_id: str, count: int = 1, lease_seconds: Optional[float] = None) -> List[CrawlLease]:
+        """
+        Leases up to `count` pending (or expired) keys to worker
+        """
+        lease_seconds = lease_seconds or self._lease_seconds
+        now = time.time()
+        expires_at = now + lease_seconds
+
+        conn = self._connect()
+        try:
+            # Write lock up front so two workers can't grab the same keys
+            # (outside the inner try, there's nothing to roll back if it times out)
+            conn.execute('BEGIN IMMEDIATE')
+        except Exception:
+            conn.close()
+            raise
+
+        try:
+            # Expired leases that have used up their attempts are failures
+            conn.execute(
+                'UPDATE crawl_tasks SET status = ?, error = ?, worker_id = NULL, updated_at = ? '
+                'WHERE status = ? AND expires_at < ? AND attempts >= max_attempts',
+                (STATUS_FAILED, 'lease expired', now, STATUS_LEASED, now)
+            )
+
+            # Separate queries so pending keys are read in order straight off
+            # crawl_tasks_lease (an OR across statuses sorts every candidate)
+            rows = conn.execute(
+                'SELECT query_type, key, attempts, updated_at FROM crawl_tasks '
+                'WHERE status = ? ORDER BY attempts, updated_at LIMIT ?',
+                (STATUS_PENDING, count)
+            ).fetchall() + conn.execute(
+                'SELECT query_type, key, attempts, updated_at FROM crawl_tasks '
+                'WHERE status = ? AND expires_at < ? ORDER BY attempts, updated_at LIMIT ?',
+                (STATUS_LEASED, now, count)
+            ).fetchall()
+            rows = sorted(rows, key=lambda row: (row['attempts'], row['updated_at']))[:count]
+
+            conn.executemany(
+                'UPDATE crawl_tasks SET status = ?, worker_id = ?, expires_at = ?, '
+                'attempts = attempts + 1, updated_at = ? WHERE query_type = ? AND key = ?',
+                [(STATUS_LEASED, worker_id, expires_at, now, row['query_type'], row['key']) for row in rows]
+            )
+            conn.execute('COMMIT')
+
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+
+        finally:
+            conn.close()
+
+        return [
+            {
+                'query_type': QueryType(row['query_type']),
+                'key': row['key'],
+                'worker_id': worker_id,
+                'attempts': row['attempts'] + 1,
+                'expires_at': expires_at
+            }
+            for row in rows
+        ]
+
+    def _update_leased(self, lease: CrawlLease, sql: str, params: tuple) -> bool:
+        """
+        Runs update only if the worker still holds the lease
+        """
+        conn = self._connect()
+        try:
+            cur = conn.execute(
+                sql + ' WHERE query_type = ? AND key = ? AND worker_id = ? AND status = ?',
+                params + (lease['query_type'], lease['key'], lease['worker_id'], STATUS_LEASED)
+            )
+            return cur.rowcount == 1
+        finally:
+            conn.close()
+
+    def renew(self, lease: CrawlLease, lease_seconds: Optional[float] = None) -> bool:
+        """
+        Extends lease, returns False if the lease was lost (expired and re-leased)
+        """
+        now = time.time()
+        expires_at = now + (lease_seconds or self._lease_seconds)
+
+        renewed = self._update_leased(
+            lease,
+            'UPDATE crawl_tasks SET expires_at = ?, updated_at = ?',
+            (expires_at, now)
+        )
+        if renewed:
+            lease['expires_at'] = expires_at
+        return renewed
+
+    def complete(self, lease: CrawlLease, result) -> bool:
+        """
+        Stores (JSON serializable) result for leased key
+        """
+        return self._update_leased(
+            lease,
+            'UPDATE crawl_tasks SET status = ?, result = ?, error = NULL, expires_at = NULL, updated_at = ?',
+            (STATUS_DONE, json.dumps(result), time.time())
+        )
+
+    def fail(self, lease: CrawlLease, error: str) -> bool:
+        """
+        Reports failure, key goes back to pending unless it's out of attempts
+        """
+        return self._update_leased(
+            lease,
+            'UPDATE crawl_tasks SET status = CASE WHEN attempts >= max_attempts THEN ? ELSE ? END, '
+            'error = ?, worker_id = NULL, expires_at = NULL, updated_at = ?',
+            (STATUS_FAILED, STATUS_PENDING, error, time.time())
+        )
+
+    def results(self, query_type: QueryType = INSTA_LOCATION):
+        """
+        Yields (key, result) for completed keys
+        """
+        conn = self._connect()
+        try:
+            for row in conn.execute(
+                    'SELECT key, result FROM crawl_tasks WHERE query_type = ? AND status = ?',
+                    (query_type, STATUS_DONE)):
+                yield row['key'], json.loads(row['result'])
+        finally:
+            conn.close()
+
+    def stats(self) -> dict:
+        """
+        Number of keys in each status
+        """
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                'SELECT status, COUNT(*) AS n FROM crawl_tasks GROUP BY status'
+            ).fetchall()
+        finally:
+            conn.close()
+
+        ret = {STATUS_PENDING: 0, STATUS_LEASED: 0, STATUS_DONE: 0, STATUS_FAILED: 0}
+        ret.update({row['status']: row['n'] for row in rows})
+        return ret
+
+
+def default_worker_id() -> str:
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def instagram_crawl_handler(count: int = 32) -> Callable[[QueryType, str], InstagramPosts]:
+    """
+    Handler for `run_worker` that queries instagram and standardizes the posts
+    """
+    def handler(query_type: QueryType, key: str) -> InstagramPosts:
+        return standardize_instagram_posts(Instagram(query_type).query(key, count=count))
+
+    return handler
+
+
+def run_worker(queue: CrawlQueue,
+               handler: Callable[[QueryType, str], object],
+               worker_id: Optional[str] = None,
+               batch_size: int = 1,
+               idle_sleep: float = 5.0,
+               stop_when_empty: bool = True):
+    """
+    Leases keys and runs `handler(query_type, key)` on them until queue is empty.
+    Leases are renewed in the background while the handler is running.
+
+    Params:
+        queue:           Shared crawl queue
+        handler:         Returns JSON serializable result, raises on failure
+        worker_id:       Unique name of this worker (defaults to host:pid)
+        batch_size:      Keys leased per round trip to the database
+        idle_sleep:      Seconds to wait when there is nothing to lease
+        stop_when_empty: Return once there's nothing pending or leased
+    """
+    worker_id = worker_id or default_worker_id()
+
+    while True:
+        leases = queue.lease(worker_id, count=batch_size)
+
+        if len(leases) == 0:
+            stats = queue.stats()
+            if stop_when_empty and stats[STATUS_PENDING] == 0 and stats[STATUS_LEASED] == 0:
+                return
+            time.sleep(idle_sleep)
+            continue
+
+        # One heartbeat (at a third of the lease) renews every lease in the batch,
+        # keys waiting their turn mustn't expire and burn attempts before they run
+        held = set((lease['query_type'], lease['key']) for lease in leases)
+        held_lock = threading.Lock()
+        done = threading.Event()
+        interval = max(1.0, (leases[0]['expires_at'] - time.time()) / 3)
+
+        def heartbeat():
+            while not done.wait(interval):
+                for lease in leases:
+                    lease_key = (lease['query_type'], lease['key'])
+                    with held_lock:
+                        if lease_key not in held:
+                            continue
+                    if not queue.renew(lease):
+                        with held_lock:
+                            held.discard(lease_key)
+
+        heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+        heartbeat_thread.start()
+
+        try:
+            for lease in leases:
+                lease_key = (lease['query_type'], lease['key'])
+
+                # Lost it (expired and re-leased by another worker)
+                with held_lock:
+                    if lease_key not in held:
+                        continue
+
+                try:
+                    result = handler(lease['query_type'], lease['key'])
+                except Exception as e:
+                    with held_lock:
+                        held.discard(lease_key)
+                    queue.fail(lease, repr(e))
+                    continue
+
+                with held_lock:
+                    held.discard(lease_key)
+                queue.complete(lease, result)
+
+        finally:
+            done.set()
+            heartbeat_thread.join()
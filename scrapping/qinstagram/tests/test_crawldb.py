@@ -0,0 +1,175 @@
+import pytest
+
+from qinstagram.crawldb import CrawlDB
+
+
+def make_location(pk, lat, lng, name='place'):
+    return {
+        'pk': pk,
+        'facebook_places_id': 'fb{}'.format(pk),
+        'name': name,
+        'lat': lat,
+        'lng': lng
+    }
+
+
+def make_post(instagram_id, taken_at_timestamp):
+    return {
+        'instagram_id': str(instagram_id),
+        'shortcode': 'sc{}'.format(instagram_id),
+        'display_url': 'https://example.com/{}.jpg'.format(instagram_id),
+        'thumbnail_url': 'https://example.com/{}_t.jpg'.format(instagram_id),
+        'caption': '',
+        'owner_id': 'owner',
+        'taken_at_timestamp': taken_at_timestamp
+    }
+
+
+@pytest.fixture
+def crawl_db():
+    db = CrawlDB(':memory:')
+    yield db
+    db.close()
+
+
+def test_query_locations_bbox(crawl_db):
+    crawl_db.upsert_locations([
+        make_location('1', 48.85, 2.35, 'paris'),
+        make_location('2', 51.50, -0.12, 'london'),
+        make_location('0', 40.71, -74.0, 'new york')
+    ])
+    crawl_db.upsert_tag_counts([('1', None, 10), ('2', None, 20), ('fb0', None, 30)])
+
+    europe = crawl_db.query_locations((35, -15, 60, 30))
+    assert sorted(x['name'] for x in europe) == ['london', 'paris']
+
+    everything = crawl_db.query_locations()
+    assert sorted(x['location_id'] for x in everything) == ['1', '2', 'fb0']
+
+
+def test_query_locations_skips_uncrawled(crawl_db):
+    crawl_db.upsert_locations([make_location('1', 10, 20)])
+    assert crawl_db.query_locations() == []
+
+
+def test_upsert_locations_moves_rtree_entry(crawl_db):
+    crawl_db.upsert_locations([make_location('1', 10, 20)])
+    crawl_db.upsert_locations([make_location('1', 50, 60)])
+    crawl_db.upsert_tag_counts([('1', None, 5)])
+
+    assert crawl_db.query_locations((0, 0, 30, 30)) == []
+    assert len(crawl_db.query_locations((40, 50, 60, 70))) == 1
+
+
+def test_posts_upsert_keeps_current_tag_count(crawl_db):
+    crawl_db.upsert_locations([make_location('1', 10, 20)])
+    crawl_db.upsert_tag_counts([('1', None, 123)], crawled_at=100)
+    crawl_db.upsert_posts('1', {
+        'total_media_count': 7,
+        'recent_posts': [make_post(1, 50)],
+        'top_posts': []
+    }, crawled_at=200)
+
+    location, = crawl_db.query_locations()
+    assert location['current_tag_count'] == 123
+    assert location['total_media_count'] == 7
+    assert location['crawled_at'] == 200
+
+
+def test_query_locations_time_range(crawl_db):
+    crawl_db.upsert_locations([make_location('1', 10, 20)])
+    crawl_db.upsert_tag_counts([('1', None, 1)], crawled_at=100)
+    crawl_db.upsert_tag_counts([('1', None, 2)], crawled_at=200)
+
+    assert crawl_db.query_locations(until=150)[0]['current_tag_count'] == 1
+    assert crawl_db.query_locations(since=150)[0]['current_tag_count'] == 2
+    assert crawl_db.query_locations(since=300) == []
+
+
+def test_query_posts_and_location_lookup(crawl_db):
+    crawl_db.upsert_locations([make_location('1', 10, 20), make_location('2', 50, 60)])
+    crawl_db.upsert_crawl_results([
+        ('1', {
+            'total_media_count': 3,
+            'recent_posts': [make_post(1, 300), make_post(2, 200)],
+            'top_posts': [make_post(2, 200), make_post(3, 100)]
+        }),
+        ('2', {
+            'total_media_count': 1,
+            'recent_posts': [make_post(4, 400)],
+            'top_posts': []
+        })
+    ])
+
+    in_bbox = crawl_db.query_posts(bbox=(0, 0, 30, 30), since=150)
+    assert [x['instagram_id'] for x in in_bbox] == ['1', '2']
+
+    posts = crawl_db.get_location_posts('1', count=2)
+    assert posts['total_media_count'] == 3
+    assert [x['instagram_id'] for x in posts['recent_posts']] == ['1', '2']
+    assert [x['instagram_id'] for x in posts['top_posts']] == ['2', '3']
+
+    assert crawl_db.get_location_posts('missing') is None
+
+
+def test_main_records_crawl(tmp_path, monkeypatch):
+    import main
+
+    db_path = str(tmp_path / 'crawl.db')
+    monkeypatch.setenv('CRAWL_DB', db_path)
+    monkeypatch.setattr(main, 'instagram_query_location', lambda *args, **kwargs: {
+        'success': True,
+        'posts': {
+            'total_media_count': 9,
+            'top_posts': [],
+            'recent_posts': [{'node': {
+                'id': '1',
+                'display_url': 'd',
+                'thumbnail_src': 't',
+                'shortcode': 's',
+                'taken_at_timestamp': 10,
+                'owner': {'id': 'o'}
+            }}]
+        }
+    })
+
+    ret, status_code = main.query_location({'location_id': '42'})
+    assert status_code == 200
+
+    crawl_db = CrawlDB(db_path)
+    assert crawl_db.get_location_posts('42')['total_media_count'] == 9
+    crawl_db.close()
+
+
+def test_top_posts_follow_latest_crawl(crawl_db):
+    for crawl in range(3):
+        crawl_db.upsert_posts('1', {
+            'total_media_count': 10,
+            'recent_posts': [make_post(100 + crawl, 1000 + crawl)],
+            'top_posts': [make_post(crawl * 10 + i, i) for i in range(9)]
+        }, crawled_at=crawl)
+
+    top_posts = crawl_db.get_location_posts('1')['top_posts']
+    assert sorted(x['instagram_id'] for x in top_posts) == sorted(str(20 + i) for i in range(9))
+
+
+def test_post_in_recent_and_top_stays_top(crawl_db):
+    crawl_db.upsert_posts('1', {
+        'total_media_count': 1,
+        'recent_posts': [make_post(1, 10)],
+        'top_posts': [make_post(1, 10)]
+    })
+
+    assert [x['instagram_id'] for x in crawl_db.get_location_posts('1')['top_posts']] == ['1']
+
+
+def test_import_raw_data(crawl_db):
+    crawl_db.import_raw_data([
+        {'latitude': 48.85, 'longitude': 2.35, 'current_tag_count': 1000},
+        {'location_id': '7', 'name': 'london', 'latitude': 51.5, 'longitude': -0.12, 'current_tag_count': 10}
+    ])
+
+    locations = sorted(crawl_db.query_locations(), key=lambda x: x['location_id'])
+    assert [(x['location_id'], x['current_tag_count']) for x in locations] == [
+        ('48.85,2.35', 1000), ('7', 10)
+    ]
@@ -0,0 +1,151 @@
+import io
+import threading
+import time
+
+import pytest
+import requests
+
+import main
+from qinstagram import fetch
+
+
+def make_response(body: bytes) -> requests.Response:
+    r = requests.Response()
+    r.status_code = 200
+    r.raw = io.BytesIO(body)
+    return r
+
+
+@pytest.fixture
+def tracker(monkeypatch):
+    tracker = fetch.LatencyTracker()
+    monkeypatch.setattr(fetch, 'latency_tracker', tracker)
+    return tracker
+
+
+def test_deadline_covers_whole_response(tracker, monkeypatch):
+    # Server dripping bytes: each read is within the read timeout, the response isn't
+    monkeypatch.setattr(fetch.requests, 'get', lambda url, **kwargs: time.sleep(2.0))
+
+    start = time.time()
+    with pytest.raises(fetch.DeadlineExceeded):
+        fetch.get('page', 'https://example.com', deadline=time.time() + 0.3)
+
+    assert time.time() - start < 1.0
+
+
+def test_slow_body_is_abandoned_at_deadline(tracker, monkeypatch):
+    closed = threading.Event()
+
+    class DrippingBody(io.RawIOBase):
+        def readinto(self, b):
+            time.sleep(0.05)
+            b[0:1] = b'x'
+            return 1
+
+        def close(self):
+            closed.set()
+            super().close()
+
+    def fake_get(url, stream=False, **kwargs):
+        assert stream
+        r = make_response(b'')
+        r.raw = DrippingBody()
+        return r
+
+    monkeypatch.setattr(fetch.requests, 'get', fake_get)
+    monkeypatch.setattr(fetch, 'READ_CHUNK_SIZE', 1)
+
+    with pytest.raises(fetch.DeadlineExceeded):
+        fetch.get('page', 'https://example.com', deadline=time.time() + 0.3)
+
+    # Pool thread stops reading and drops the connection, it doesn't drip forever
+    assert closed.wait(1.0)
+
+
+def test_deadline_already_passed(tracker):
+    with pytest.raises(fetch.DeadlineExceeded):
+        fetch.get('page', 'https://example.com', deadline=time.time() - 1)
+
+
+def test_timeouts_capped_by_deadline(tracker, monkeypatch):
+    seen = {}
+
+    def fake_get(url, timeout=None, **kwargs):
+        seen['timeout'] = timeout
+        return make_response(b'ok')
+
+    monkeypatch.setattr(fetch.requests, 'get', fake_get)
+
+    assert fetch.get('page', 'https://example.com', deadline=time.time() + 1).text == 'ok'
+    assert seen['timeout'][0] <= 1 and seen['timeout'][1] <= 1
+
+    assert fetch.get('page', 'https://example.com').text == 'ok'
+    assert seen['timeout'] == fetch.DEFAULT_TIMEOUTS['page']
+
+
+def test_hedge_sent_after_percentile_and_first_response_wins(tracker, monkeypatch):
+    for _ in range(50):
+        tracker.record('graphql', 0.05)
+
+    calls = []
+    lock = threading.Lock()
+
+    def fake_get(url, **kwargs):
+        with lock:
+            calls.append(time.time())
+            attempt = len(calls)
+        # First attempt stalls, hedge answers quickly
+        time.sleep(1.0 if attempt == 1 else 0.01)
+        return attempt
+
+    monkeypatch.setattr(fetch.requests, 'get', fake_get)
+
+    start = time.time()
+    assert fetch.get('graphql', 'https://example.com', hedge_percentile=95) == 2
+    assert time.time() - start < 0.5
+    assert len(calls) == 2
+
+
+def test_no_hedge_without_history(tracker, monkeypatch):
+    calls = []
+    monkeypatch.setattr(fetch.requests, 'get', lambda url, **kwargs: calls.append(url) or 'ok')
+
+    assert fetch.get('graphql', 'https://example.com', hedge_percentile=95) == 'ok'
+    assert len(calls) == 1
+
+
+def test_hedge_fails_only_if_every_attempt_fails(tracker, monkeypatch):
+    for _ in range(50):
+        tracker.record('page', 0.01)
+
+    def fake_get(url, **kwargs):
+        time.sleep(0.05)
+        raise requests.ConnectionError('refused')
+
+    monkeypatch.setattr(fetch.requests, 'get', fake_get)
+
+    with pytest.raises(requests.ConnectionError):
+        fetch.get('page', 'https://example.com', hedge_percentile=95)
+
+
+def test_timeouts_are_recorded(tracker, monkeypatch):
+    def fake_get(url, **kwargs):
+        raise requests.ReadTimeout('slow')
+
+    monkeypatch.setattr(fetch.requests, 'get', fake_get)
+
+    with pytest.raises(requests.Timeout):
+        fetch.get('page', 'https://example.com')
+
+    assert tracker.percentile('page', 50, min_samples=1) is not None
+
+
+def test_hedge_percentile_is_clamped(monkeypatch):
+    monkeypatch.delenv('INSTA_HEDGE_PERCENTILE', raising=False)
+
+    assert main.get_hedge_percentile({'hedge_percentile': 0}) == fetch.MIN_HEDGE_PERCENTILE
+    assert main.get_hedge_percentile({'hedge_percentile': 1000}) == fetch.MAX_HEDGE_PERCENTILE
+    assert main.get_hedge_percentile({'hedge_percentile': '95'}) == 95
+    assert main.get_hedge_percentile({'hedge_percentile': 'nan'}) is None
+    assert main.get_hedge_percentile({}) is None
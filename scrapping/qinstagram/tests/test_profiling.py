@@ -0,0 +1,80 @@
+import json
+import os
+
+import main
+from qinstagram import profiling
+
+
+def test_save_keeps_name_inside_output_dir(tmp_path):
+    output_dir = tmp_path / 'profiles'
+    profile = profiling.Profile('../../escaped')
+
+    prefix = profile.save(str(output_dir))
+
+    assert os.path.dirname(prefix) == str(output_dir)
+    assert sorted(os.listdir(str(output_dir))) == sorted(
+        [os.path.basename(prefix) + '.folded', os.path.basename(prefix) + '.json']
+    )
+    assert not (tmp_path / 'escaped').exists()
+
+
+def test_profiling_failure_does_not_raise(tmp_path, monkeypatch):
+    def broken_save(self, output_dir):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(profiling.Profile, 'save', broken_save)
+
+    with profiling.profile_invocation('query_location', output_dir=str(tmp_path)) as profile:
+        result = 42
+
+    assert result == 42
+    assert profile is not None
+    assert profiling._active_profile is None
+
+
+def test_body_exceptions_still_propagate(tmp_path):
+    try:
+        with profiling.profile_invocation('query_location', output_dir=str(tmp_path)):
+            raise ValueError('boom')
+    except ValueError as e:
+        assert str(e) == 'boom'
+    else:
+        assert False, 'expected ValueError'
+
+
+def test_stage_records_time(tmp_path):
+    with profiling.profile_invocation('query_location', output_dir=str(tmp_path)) as profile:
+        with profiling.stage('work'):
+            [str(i) for i in range(1000)]
+        with profiling.stage('work'):
+            pass
+
+    assert 'work' in profile.stages
+    assert profile.stages['work'][0] >= 0
+
+
+def test_invalid_action_is_rejected_before_profiling(tmp_path, monkeypatch):
+    monkeypatch.setenv('QINSTAGRAM_PROFILE_DIR', str(tmp_path))
+
+    for action in ('../../escaped', 'a/b'):
+        ret = main.lambda_main_function(
+            {'body': json.dumps({'action': action, 'profile': True})}, None
+        )
+        assert ret['statusCode'] == 400
+        assert json.loads(ret['body']) == {'error': 'invalid action'}
+
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_payload_flag_needs_env_opt_in(monkeypatch):
+    monkeypatch.delenv('QINSTAGRAM_PROFILE', raising=False)
+    monkeypatch.delenv('QINSTAGRAM_PROFILE_RATE', raising=False)
+    monkeypatch.delenv('QINSTAGRAM_PROFILE_ALLOW_PAYLOAD', raising=False)
+
+    assert not profiling.should_profile({'profile': True})
+
+    monkeypatch.setenv('QINSTAGRAM_PROFILE_ALLOW_PAYLOAD', '1')
+    assert profiling.should_profile({'profile': True})
+    assert not profiling.should_profile({'profile': 'false'})
+    assert not profiling.should_profile({'profile': 1})
+    assert not profiling.should_profile({})
@@ -0,0 +1,151 @@
+import random
+
+from qinstagram.stats import (
+    POPULARITY_METRICS,
+    HyperLogLog,
+    LocationStats,
+    SlidingWindowCounter,
+    StatsEngine,
+    TDigest
+)
+from qinstagram.workqueue import CrawlQueue
+
+
+def make_posts(posts, top_posts=(), total_media_count=0):
+    def post(instagram_id, taken_at_timestamp, owner_id='owner'):
+        return {
+            'instagram_id': str(instagram_id),
+            'taken_at_timestamp': taken_at_timestamp,
+            'owner_id': owner_id
+        }
+
+    return {
+        'total_media_count': total_media_count,
+        'recent_posts': [post(*p) for p in posts],
+        'top_posts': [post(*p) for p in top_posts]
+    }
+
+
+def test_hyperloglog_accuracy():
+    hll = HyperLogLog(p=10)
+    for i in range(20000):
+        hll.add('user{}'.format(i))
+        hll.add('user{}'.format(i))
+
+    # ~3.2% std error at p=10, allow 4 sigma
+    assert abs(hll.count() - 20000) / 20000 < 0.13
+
+
+def test_hyperloglog_small_counts_exactish():
+    hll = HyperLogLog()
+    for i in range(10):
+        hll.add(str(i))
+    assert hll.count() == 10
+
+
+def test_tdigest_quantiles():
+    rng = random.Random(0)
+    values = [rng.expovariate(1) for _ in range(20000)]
+
+    digest = TDigest()
+    for value in values:
+        digest.add(value)
+
+    values.sort()
+    for q in (0.01, 0.5, 0.9, 0.99):
+        exact = values[int(q * len(values))]
+        assert abs(digest.quantile(q) - exact) <= 0.05 * exact + 0.01
+
+    # Fixed memory
+    assert len(digest.centroids) <= digest.compression
+
+
+def test_tdigest_roundtrip():
+    digest = TDigest()
+    for value in range(100):
+        digest.add(value)
+
+    restored = TDigest.from_dict(digest.to_dict())
+    assert restored.quantile(0.5) == digest.quantile(0.5)
+
+
+def test_sliding_window_drops_old_buckets():
+    counter = SlidingWindowCounter(bucket_seconds=10, num_buckets=3)
+    counter.add(5)
+    counter.add(15)
+    counter.add(25)
+    assert counter.count(30, now=29) == 3
+
+    # Moves the ring forward, bucket of t=5 is reused
+    counter.add(35)
+    assert counter.count(30, now=39) == 3
+    assert counter.count(10, now=39) == 1
+
+    # Older than the ring, ignored
+    counter.add(0)
+    assert counter.count(30, now=39) == 3
+
+
+def test_gaps_ignore_top_posts():
+    stats = LocationStats()
+    stats.update(make_posts(
+        [(1, 1000), (2, 1100), (3, 1200)],
+        top_posts=[(9, 100), (2, 1100)]
+    ))
+
+    assert stats.post_gaps.quantile(0.0) == 100
+    assert stats.post_gaps.quantile(1.0) == 100
+    assert stats.posts_window.count(3600, now=1200) == 3
+
+
+def test_gaps_not_bridged_without_overlap():
+    stats = LocationStats()
+    stats.update(make_posts([(1, 1000), (2, 1100)]))
+
+    # Didn't reach back to t=1100, there may be posts in between
+    stats.update(make_posts([(3, 50000), (4, 50100)]))
+    assert stats.post_gaps.max == 100
+
+    # Overlaps the last seen post, bridge it
+    stats.update(make_posts([(4, 50100), (5, 50300)]))
+    assert stats.post_gaps.max == 200
+
+    # Pure re-crawl adds nothing
+    stats.update(make_posts([(4, 50100), (5, 50300)]))
+    assert stats.posts_window.count(3600, now=50300) == 3
+
+
+def test_unique_posters_include_top_posts():
+    stats = LocationStats()
+    stats.update(make_posts([(1, 1000, 'a'), (2, 1100, 'b')], top_posts=[(3, 10, 'c')]))
+    assert stats.unique_posters.count() == 3
+
+
+def test_engine_save_and_load(tmp_path):
+    engine = StatsEngine()
+    engine.update('42', make_posts([(1, 1000), (2, 1600)], total_media_count=5))
+
+    path = str(tmp_path / 'stats.json')
+    engine.save(path)
+    restored = StatsEngine.load(path)
+
+    assert restored.summaries(now=1600) == engine.summaries(now=1600)
+    assert restored.summaries(now=1600)['42']['total_media_count'] == 5
+
+
+def test_engine_ingests_crawl_queue_results(tmp_path):
+    queue = CrawlQueue(str(tmp_path / 'queue.db'))
+    queue.add(['42'])
+    lease, = queue.lease('a')
+    queue.complete(lease, make_posts([(1, 1000, 'a'), (2, 1600, 'b')], total_media_count=5))
+
+    engine = StatsEngine()
+    engine.update_crawl_results(queue.results())
+    # Re-running over the same results doesn't double count
+    engine.update_crawl_results(queue.results())
+
+    summary = engine.summaries(now=1600)['42']
+    assert summary['posts_per_hour_24h'] == 2 / 24
+    assert summary['unique_posters'] == 2
+    assert summary['post_gap_p50'] == 600
+    assert set(POPULARITY_METRICS) <= set(summary)
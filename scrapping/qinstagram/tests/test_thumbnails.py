@@ -0,0 +1,158 @@
+import io
+import os
+
+import pytest
+from PIL import Image
+
+from qinstagram import thumbnails
+from qinstagram.thumbnails import ThumbnailCache, fetch_post_thumbnails, unique_post_images
+
+
+def make_image(color) -> bytes:
+    buf = io.BytesIO()
+    Image.new('RGB', (800, 600), color).save(buf, 'PNG')
+    return buf.getvalue()
+
+
+def make_posts(urls):
+    return {
+        'total_media_count': len(urls),
+        'top_posts': [],
+        'recent_posts': [
+            {'instagram_id': instagram_id, 'thumbnail_url': url, 'display_url': url}
+            for instagram_id, url in urls
+        ]
+    }
+
+
+@pytest.fixture
+def downloads(monkeypatch):
+    downloaded = []
+
+    def fake_download(url, timeout):
+        downloaded.append(url)
+        # Same image regardless of url signature
+        return make_image((len(url.split('?')[0]) * 10 % 256, 0, 0))
+
+    monkeypatch.setattr(thumbnails, '_download_image', fake_download)
+    return downloaded
+
+
+def test_recrawl_with_resigned_urls_hits_cache(tmp_path, downloads):
+    cache = ThumbnailCache(str(tmp_path))
+    first = fetch_post_thumbnails(make_posts([('1', 'https://cdn/a.jpg?oe=1')]), cache, sizes=(64,), max_resizers=0)
+    assert downloads == ['https://cdn/a.jpg?oe=1']
+
+    # New process, new url signature
+    cache = ThumbnailCache(str(tmp_path))
+    second = fetch_post_thumbnails(make_posts([('1', 'https://cdn/a.jpg?oe=2')]), cache, sizes=(64,), max_resizers=0)
+
+    assert downloads == ['https://cdn/a.jpg?oe=1']
+    assert first == second
+    with Image.open(second['1'][64]) as img:
+        assert max(img.size) == 64
+
+
+def test_shared_url_is_downloaded_once_for_every_post(tmp_path, downloads):
+    cache = ThumbnailCache(str(tmp_path))
+    posts = make_posts([('1', 'https://cdn/a.jpg'), ('2', 'https://cdn/a.jpg'), ('1', 'https://cdn/a.jpg')])
+
+    assert unique_post_images(posts) == [('1', 'https://cdn/a.jpg'), ('2', 'https://cdn/a.jpg')]
+
+    ret = fetch_post_thumbnails(posts, cache, sizes=(64,), max_resizers=0)
+    assert downloads == ['https://cdn/a.jpg']
+    assert sorted(ret) == ['1', '2']
+    assert ret['1'] == ret['2']
+
+
+def test_eviction_keeps_returned_files(tmp_path, downloads):
+    cache = ThumbnailCache(str(tmp_path), max_bytes=1)
+    ret = fetch_post_thumbnails(
+        make_posts([('1', 'https://cdn/a.jpg'), ('2', 'https://cdn/bb.jpg')]),
+        cache, sizes=(64, 128), max_resizers=0
+    )
+
+    for thumbs in ret.values():
+        assert len(thumbs) == 2
+        for path in thumbs.values():
+            assert os.path.exists(path)
+
+
+def test_eviction_removes_least_recently_used(tmp_path):
+    cache = ThumbnailCache(str(tmp_path), max_bytes=150)
+    old = cache.put('https://cdn/old', b'o' * 100, ['1'])
+    os.utime(cache.object_path(old), (1, 1))
+    new = cache.put('https://cdn/new', b'n' * 100, ['2'])
+
+    cache.evict()
+
+    assert not os.path.exists(cache.object_path(old))
+    assert os.path.exists(cache.object_path(new))
+    assert cache.lookup('https://cdn/old', '1') is None
+    assert cache.lookup('https://cdn/other', '2') == new
+
+
+class FakeResponse:
+    def __init__(self, content):
+        self.content = content
+
+    def raise_for_status(self):
+        pass
+
+
+def test_non_image_response_is_not_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(thumbnails.requests, 'get', lambda url, timeout: FakeResponse(b'<html>login</html>'))
+    cache = ThumbnailCache(str(tmp_path))
+
+    ret = fetch_post_thumbnails(make_posts([('1', 'https://cdn/a.jpg')]), cache, sizes=(64,), max_resizers=0)
+
+    assert ret == {}
+    assert cache.lookup('https://cdn/a.jpg', '1') is None
+    assert os.listdir(os.path.join(str(tmp_path), 'objects')) == []
+
+
+def test_failed_resize_drops_post_and_leaves_no_temp_files(tmp_path):
+    cache = ThumbnailCache(str(tmp_path))
+    # Corrupt original that somehow made it into the cache
+    cache.put('https://cdn/a.jpg', b'not an image', ['1'])
+
+    ret = fetch_post_thumbnails(make_posts([('1', 'https://cdn/a.jpg')]), cache, sizes=(64,), max_resizers=0)
+
+    assert ret == {}
+    thumbs_dir = os.path.join(str(tmp_path), 'thumbs')
+    assert [files for _, _, files in os.walk(thumbs_dir) if len(files) > 0] == []
+
+
+def test_evict_only_walks_cache_when_over_budget(tmp_path, monkeypatch):
+    cache = ThumbnailCache(str(tmp_path), max_bytes=250)
+    walks = []
+    real_walk = os.walk
+    monkeypatch.setattr(thumbnails.os, 'walk', lambda path: walks.append(path) or real_walk(path))
+
+    cache.put('https://cdn/a', b'a' * 100, ['1'])
+    # First call has to find out how big the cache already is
+    cache.evict()
+    assert len(walks) == 2
+
+    cache.put('https://cdn/b', b'b' * 100, ['2'])
+    cache.evict()
+    assert len(walks) == 2
+
+    cache.put('https://cdn/c', b'c' * 100, ['3'])
+    cache.evict()
+    assert len(walks) == 4
+    assert cache.lookup('https://cdn/a', '1') is None
+
+
+def test_resize_in_process_pool(tmp_path, downloads):
+    cache = ThumbnailCache(str(tmp_path))
+    ret = fetch_post_thumbnails(
+        make_posts([('1', 'https://cdn/a.jpg'), ('2', 'https://cdn/bb.jpg')]),
+        cache, sizes=(64, 128), max_resizers=2
+    )
+
+    assert sorted(ret) == ['1', '2']
+    for thumbs in ret.values():
+        for size, path in thumbs.items():
+            with Image.open(path) as img:
+                assert max(img.size) == size
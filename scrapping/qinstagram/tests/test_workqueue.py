@@ -0,0 +1,156 @@
+import sqlite3
+import time
+
+import pytest
+
+from qinstagram.types import INSTA_LOCATION, INSTA_USER
+from qinstagram.workqueue import (
+    CrawlQueue,
+    STATUS_DONE,
+    STATUS_FAILED,
+    STATUS_LEASED,
+    STATUS_PENDING,
+    run_worker
+)
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return CrawlQueue(str(tmp_path / 'queue.db'), max_attempts=2, lease_seconds=60)
+
+
+def test_add_is_idempotent(queue):
+    assert queue.add(['1', '2']) == 2
+    assert queue.add(['2', '3']) == 1
+    assert queue.add(['1'], query_type=INSTA_USER) == 1
+    assert queue.stats()[STATUS_PENDING] == 4
+
+
+def test_lease_complete(queue):
+    queue.add(['1'])
+
+    lease, = queue.lease('a')
+    assert lease['attempts'] == 1
+    assert queue.lease('b') == []
+    assert queue.stats()[STATUS_LEASED] == 1
+
+    assert queue.complete(lease, {'ok': True})
+    assert list(queue.results(INSTA_LOCATION)) == [('1', {'ok': True})]
+    assert queue.stats()[STATUS_DONE] == 1
+
+
+def test_fail_retries_then_gives_up(queue):
+    queue.add(['1'])
+
+    lease = queue.lease('a')[0]
+    assert queue.fail(lease, 'boom')
+    assert queue.stats()[STATUS_PENDING] == 1
+
+    lease = queue.lease('a')[0]
+    assert lease['attempts'] == 2
+    assert queue.fail(lease, 'boom')
+    assert queue.stats()[STATUS_FAILED] == 1
+    assert queue.lease('a') == []
+
+
+def test_expired_lease_is_handed_to_another_worker(queue):
+    queue.add(['1'])
+
+    crashed = queue.lease('a', lease_seconds=0.01)[0]
+    time.sleep(0.05)
+
+    taken_over = queue.lease('b')[0]
+    assert taken_over['worker_id'] == 'b'
+
+    # The crashed worker can't report on (or renew) a lease it lost
+    assert not queue.renew(crashed)
+    assert not queue.complete(crashed, 'stale')
+    assert queue.complete(taken_over, 'fresh')
+    assert list(queue.results()) == [('1', 'fresh')]
+
+
+def test_expired_lease_out_of_attempts_fails(queue):
+    queue.add(['1'])
+    for _ in range(2):
+        queue.lease('a', lease_seconds=0.01)
+        time.sleep(0.05)
+
+    assert queue.lease('a') == []
+    assert queue.stats()[STATUS_FAILED] == 1
+
+
+def test_run_worker(queue):
+    queue.add(['good', 'bad', 'also good'])
+
+    def handler(query_type, key):
+        if key == 'bad':
+            raise ValueError(key)
+        return key.upper()
+
+    run_worker(queue, handler, worker_id='w', batch_size=2)
+
+    assert dict(queue.results()) == {'good': 'GOOD', 'also good': 'ALSO GOOD'}
+    assert queue.stats()[STATUS_FAILED] == 1
+
+
+def test_batch_leases_stay_renewed_while_waiting(tmp_path):
+    queue = CrawlQueue(str(tmp_path / 'queue.db'), max_attempts=1, lease_seconds=1.5)
+    queue.add(['1', '2', '3'])
+
+    ran = []
+
+    def slow_handler(query_type, key):
+        ran.append(key)
+        time.sleep(1.0)
+        return key
+
+    run_worker(queue, slow_handler, worker_id='w', batch_size=3)
+
+    assert sorted(ran) == ['1', '2', '3']
+    assert queue.stats()[STATUS_DONE] == 3
+
+
+def test_lock_timeout_error_is_not_masked(tmp_path):
+    class ImpatientQueue(CrawlQueue):
+        def _connect(self):
+            conn = sqlite3.connect(self._db_path, timeout=0.05, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            return conn
+
+    queue = ImpatientQueue(str(tmp_path / 'queue.db'))
+    queue.add(['1'])
+
+    blocker = sqlite3.connect(str(tmp_path / 'queue.db'), isolation_level=None)
+    blocker.execute('BEGIN IMMEDIATE')
+    try:
+        with pytest.raises(sqlite3.OperationalError, match='locked'):
+            queue.lease('a')
+    finally:
+        blocker.execute('ROLLBACK')
+        blocker.close()
+
+
+def test_lease_prefers_fewest_attempts_across_pending_and_expired(queue):
+    queue.add(['1'])
+    queue.lease('a', lease_seconds=0.01)
+    time.sleep(0.02)
+    queue.add(['2', '3'])
+
+    # '1' expired after one attempt, fresh keys go first
+    leases = queue.lease('b', count=2)
+    assert [lease['key'] for lease in leases] == ['2', '3']
+
+    lease, = queue.lease('b')
+    assert (lease['key'], lease['attempts']) == ('1', 2)
+
+
+def test_pending_lease_query_uses_index(queue):
+    conn = sqlite3.connect(queue._db_path)
+    plan = ' '.join(row[-1] for row in conn.execute(
+        'EXPLAIN QUERY PLAN SELECT query_type, key, attempts, updated_at FROM crawl_tasks '
+        'WHERE status = ? ORDER BY attempts, updated_at LIMIT ?', (STATUS_PENDING, 1)
+    ))
+    conn.close()
+
+    assert 'crawl_tasks_lease' in plan
+    assert 'TEMP B-TREE' not in plan
@@ -0,0 +1,23 @@
+"""
+Imports raw_data.json (locations + tag counts) into the crawl database, e.g.
+python scripts/import_raw_data.py raw_data.json crawl.db
+"""
+
+import os
+import sys
+import json
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'scrapping', 'qinstagram'))
+from qinstagram.crawldb import CrawlDB
+
+raw_data_path = sys.argv[1] if len(sys.argv) > 1 else 'raw_data.json'
+crawl_db_path = sys.argv[2] if len(sys.argv) > 2 else 'crawl.db'
+
+with open(raw_data_path, 'r') as f:
+    raw_data = json.load(f)
+
+crawl_db = CrawlDB(crawl_db_path)
+crawl_db.import_raw_data(raw_data)
+crawl_db.close()
+
+print('Imported {} locations into {}'.format(len(raw_data), crawl_db_path))
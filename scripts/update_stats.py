@@ -0,0 +1,29 @@
+"""
+Feeds completed crawls from a crawl queue into the popularity stats and writes
+the summaries scripts/viz_simple.py weights points by, e.g.
+python scripts/update_stats.py queue.db stats.json stats_summaries.json
+
+Stats are kept in stats.json between runs, run it after every crawl
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'scrapping', 'qinstagram'))
+from qinstagram.stats import StatsEngine
+from qinstagram.workqueue import CrawlQueue
+
+queue_path = sys.argv[1] if len(sys.argv) > 1 else 'queue.db'
+stats_path = sys.argv[2] if len(sys.argv) > 2 else 'stats.json'
+summaries_path = sys.argv[3] if len(sys.argv) > 3 else 'stats_summaries.json'
+
+if os.path.exists(stats_path):
+    engine = StatsEngine.load(stats_path)
+else:
+    engine = StatsEngine()
+
+engine.update_crawl_results(CrawlQueue(queue_path).results())
+engine.save(stats_path)
+engine.save_summaries(summaries_path)
+
+print('Wrote stats for {} locations to {}'.format(len(engine.locations), summaries_path))
@@ -1,4 +1,5 @@
 import os
+import sys
 import math
 import csv
 import json
@@ -6,17 +7,77 @@ import folium
 
 from folium.plugins import HeatMap
 
-with open('raw_data.json', 'r') as f:
-    raw_data = json.load(f)
+# Read just the region we're rendering from the crawl database, e.g.
+# CRAWL_DB=crawl.db VIZ_BBOX=41,-5,51,10 python scripts/viz_simple.py
+if os.environ.get('CRAWL_DB', None) is not None:
+    sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'scrapping', 'qinstagram'))
+    from qinstagram.crawldb import CrawlDB
 
-simple_data = list(map(
-    lambda x: {
-        'lat': x['latitude'],
-        'lng': x['longitude'],
-        'value': round(math.log10(x['current_tag_count']), 2)
-    }, raw_data
+    bbox = os.environ.get('VIZ_BBOX', None)
+    bbox = tuple(map(float, bbox.split(','))) if bbox is not None else None
+
+    crawl_db = CrawlDB(os.environ['CRAWL_DB'])
+    raw_data = crawl_db.query_locations(bbox)
+    crawl_db.close()
+
+else:
+    with open('raw_data.json', 'r') as f:
+        raw_data = json.load(f)
+
+# Optionally weight points by a popularity metric (see qinstagram.stats.POPULARITY_METRICS)
+# from the summaries written by scripts/update_stats.py, e.g.
+# STATS_METRIC=unique_posters python scripts/viz_simple.py
+stats_metric = os.environ.get('STATS_METRIC', None)
+stats_summaries = {}
+if stats_metric is not None:
+    sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'scrapping', 'qinstagram'))
+    from qinstagram.stats import POPULARITY_METRICS
+
+    # Post gaps / latest_timestamp aren't popularity, busy locations would look quiet
+    if stats_metric not in POPULARITY_METRICS:
+        sys.exit('STATS_METRIC must be one of: {}'.format(', '.join(POPULARITY_METRICS)))
+
+    with open(os.environ.get('STATS_SUMMARIES', 'stats_summaries.json'), 'r') as f:
+        stats_summaries = json.load(f)
+
+
+def point_weight(x):
+    """
+    Every point is weighted by the same metric, locations
+    without it are left off the map (None)
+    """
+    if stats_metric is None:
+        # Locations only crawled by the scraper have no tag count, use their media count
+        count = x.get('current_tag_count', None)
+        if count is None:
+            count = x.get('total_media_count', None)
+        if count is None:
+            return None
+        return round(math.log10(max(count, 1)), 2)
+
+    summary = stats_summaries.get(str(x.get('location_id', None)), {})
+    value = summary.get(stats_metric, None)
+    if value is None:
+        return None
+
+    # Shifted by 1 so quiet locations (value 0) still land in the first heatmap layer
+    return round(1 + math.log10(1 + value), 2)
+
+
+simple_data = list(filter(
+    lambda x: x['value'] is not None,
+    map(
+        lambda x: {
+            'lat': x['latitude'],
+            'lng': x['longitude'],
+            'value': point_weight(x)
+        }, raw_data
+    )
 ))
 
+if len(simple_data) == 0:
+    sys.exit('Nothing to plot (no locations with a weight in this region)')
+
 simple_data = list(
     sorted(simple_data, key=lambda x: x['value'], reverse=True)
 )